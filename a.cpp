@@ -0,0 +1,5 @@
+#include <iostream>
+
+int main () {
+    return 0;
+}
\ No newline at end of file
@@ -0,0 +1,217 @@
+import glob
+import os
+import time
+
+SOURCE_EXTENSIONS = ('.cpp', '.cc', '.cxx', '.c', '.h', '.hpp', '.hh', '.hxx')
+GLOB_CHARS = '*?['
+
+
+def is_batch(paths):
+    return len(paths) > 1 or any(os.path.isdir(path) or is_glob(path) for path in paths)
+
+
+def is_glob(path):
+    return any(char in path for char in GLOB_CHARS)
+
+
+def _glob_root(pattern):
+    # Directory part of the pattern before the first wildcard, output tree is mirrored from there
+    parts = []
+    for part in pattern.split(os.sep):
+        if is_glob(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or '.'
+
+
+def collect_sources(paths):
+    # Returns (input filename, filename relative to the output directory) pairs
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if filename.endswith(SOURCE_EXTENSIONS):
+                        full_name = os.path.join(directory, filename)
+                        sources.append((full_name, os.path.relpath(full_name, path)))
+        elif is_glob(path):
+            root = _glob_root(path)
+            for full_name in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(full_name):
+                    sources.append((full_name, os.path.relpath(full_name, root)))
+        else:
+            sources.append((path, os.path.basename(path)))
+    # A file named twice is obfuscated once, two files mapped to one output would overwrite each other
+    unique = []
+    outputs = {}
+    for full_name, relative in sources:
+        key = os.path.normcase(os.path.normpath(relative))
+        other = outputs.get(key)
+        if other is None:
+            outputs[key] = full_name
+            unique.append((full_name, relative))
+        elif os.path.realpath(other) != os.path.realpath(full_name):
+            raise ValueError(f'{other} and {full_name} are both written to {relative} of the output directory')
+    return unique
+
+
+_worker_cache = None
+_worker_tree_cache = None
+_worker_symbols = None
+
+
+def init_worker(cache_dir=None, cache_size=None, tree_cache_dir=None, compiled_grammar=False):
+    # Grammar is imported once per worker process, not per file
+    import code_obfuscator
+    if compiled_grammar:
+        import grammar_compiler
+        grammar_compiler.install()
+
+    global _worker_cache, _worker_tree_cache
+    if cache_dir is not None:
+        from refactor_cache import RefactorCache
+        _worker_cache = RefactorCache(cache_dir, cache_size or RefactorCache.DEFAULT_MAX_BYTES)
+    if tree_cache_dir is not None:
+        from tree_cache import TreeCache
+        _worker_tree_cache = TreeCache(tree_cache_dir)
+
+
+def _symbols(filename):
+    # The symbol index is mapped once per worker process
+    global _worker_symbols
+    if filename is None:
+        return None
+    if _worker_symbols is None or _worker_symbols.filename != filename:
+        from symbols import SymbolIndex
+        _worker_symbols = SymbolIndex(filename)
+    return _worker_symbols
+
+
+def collect_file(src, include_dirs=(), **kwargs):
+    # First phase of renaming for one file, see symbols.collect_file. The parse goes to the tree cache, the second
+    # phase loads it from there. A file that fails here declares nothing, its error is reported by the second phase
+    from symbols import Collected, collect_file
+    try:
+        return collect_file(src, include_dirs, tree_cache=_worker_tree_cache, **kwargs)
+    except Exception:
+        return Collected()
+
+
+def obfuscate_file(src, dst, symbols_file=None, **kwargs):
+    # Returns (src, input size in bytes, error or None, cache hits, cache misses, degraded elements report),
+    # errors are reported instead of aborting the batch
+    from code_obfuscator import CppCodeObfuscator
+    cache = _worker_cache
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    try:
+        size = os.path.getsize(src)
+        obfuscator = CppCodeObfuscator.from_file(src, cache=cache, tree_cache=_worker_tree_cache,
+                                                 symbols=_symbols(symbols_file), **kwargs)
+        os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+        with open(dst, 'w') as f:
+            obfuscator.obfuscate_to(f)
+    except Exception as e:
+        return src, 0, f'{type(e).__name__}: {e}', 0, 0, []
+    degraded = obfuscator.degraded_report(src)
+    if cache:
+        return src, size, None, cache.hits - hits, cache.misses - misses, degraded
+    return src, size, None, 0, 0, degraded
+
+
+def obfuscate_source(source, **kwargs):
+    # Returns (obfuscated code, None) or (None, error) for the server, which gets sources instead of filenames
+    from code_obfuscator import CppCodeObfuscator
+    try:
+        obfuscator = CppCodeObfuscator(source, cache=_worker_cache, tree_cache=_worker_tree_cache, **kwargs)
+        obfuscator.obfuscate()
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+    return obfuscator.processed_code, None
+
+
+class BatchReport:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.failures = []
+        self.seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Report lines of elements given up over the parse budget
+        self.degraded = []
+        # Names renamed over the project
+        self.renamed = 0
+
+    def add(self, src, size, error, cache_hits=0, cache_misses=0, degraded=()):
+        if error:
+            self.failures.append((src, error))
+        else:
+            self.files += 1
+            self.bytes += size
+        self.cache_hits += cache_hits
+        self.cache_misses += cache_misses
+        self.degraded += degraded
+
+    def summary(self):
+        seconds = max(self.seconds, 1e-9)
+        return f'{self.files} files, {len(self.failures)} failed, {self.bytes / 2 ** 20:.2f} MB in {self.seconds:.2f}s: ' \
+               f'{self.files / seconds:.1f} files/s, {self.bytes / 2 ** 20 / seconds:.2f} MB/s' + \
+               (f', cache: {self.cache_hits} hits, {self.cache_misses} misses'
+                if self.cache_hits or self.cache_misses else '') + \
+               (f', {len(self.degraded)} elements over the parse budget' if self.degraded else '') + \
+               (f', {self.renamed} names renamed' if self.renamed else '')
+
+
+def rename_index(executor, files, symbols_file, include_dirs=(), **kwargs):
+    # First phase of renaming over the project files in the worker processes, writes the symbol index.
+    # Returns the number of renamed names
+    from functools import partial
+    from config import DEFAULT_SETTINGS
+    from symbols import build_index
+
+    collected = executor.map(partial(collect_file, include_dirs=include_dirs, **kwargs), files)
+    return build_index(symbols_file, files, collected, include_dirs, kwargs.get('seed'),
+                       (kwargs.get('settings') or DEFAULT_SETTINGS).key_words)
+
+
+def run_batch(paths, output_dir, jobs=None, cache_dir=None, cache_size=None, tree_cache_dir=None, compiled_grammar=False,
+              rename=False, include_dirs=(), symbols_file=None, **kwargs):
+    # With rename identifiers are renamed over all the files, the symbol index is kept in symbols_file if it is
+    # given. Imported here, the single file mode and the client only need the helpers above
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    sources = collect_sources(paths)
+    report = BatchReport()
+    start = time.perf_counter()
+    temporary = []
+    if rename and symbols_file is None:
+        handle, symbols_file = tempfile.mkstemp(suffix='.symbols')
+        os.close(handle)
+        temporary.append(symbols_file)
+    if rename and tree_cache_dir is None:
+        # Trees of the first phase are loaded by the second one instead of parsing every file again
+        tree_cache_dir = tempfile.mkdtemp(suffix='.trees')
+        temporary.append(tree_cache_dir)
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=(cache_dir, cache_size, tree_cache_dir, compiled_grammar)) as executor:
+            if rename:
+                report.renamed = rename_index(executor, [src for src, _ in sources], symbols_file, include_dirs,
+                                              **kwargs)
+                kwargs['symbols_file'] = symbols_file
+            futures = [
+                executor.submit(obfuscate_file, src, os.path.join(output_dir, relative), **kwargs)
+                for src, relative in sources
+            ]
+            for future in futures:
+                report.add(*future.result())
+    finally:
+        for path in temporary:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+    report.seconds = time.perf_counter() - start
+    return report
@@ -0,0 +1,198 @@
+#!/bin/python3
+
+import argparse
+import gc
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from code_obfuscator import CppCodeObfuscator
+from parser_utils import CodePart, node_attributes
+from corpus_generator import SHAPES, generate_source
+
+STAGES = ('parse', 'refactor', 'write')
+MEMORY = ('tree_mb', 'peak_mb', 'peak_rss_mb')
+
+
+def _time_run(source, **kwargs):
+    obfuscator = CppCodeObfuscator(source, seed=0, **kwargs)
+    times = {}
+
+    start = time.perf_counter()
+    obfuscator.parse()
+    times['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    code = ''.join(obfuscator.emit())
+    times['refactor'] = time.perf_counter() - start
+
+    with tempfile.TemporaryFile('w') as f:
+        start = time.perf_counter()
+        f.write(code)
+        f.flush()
+        times['write'] = time.perf_counter() - start
+    return times
+
+
+def _count_nodes(elements):
+    count = 0
+    stack = list(elements)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (list, tuple)):
+            stack += node
+            continue
+        if not isinstance(node, CodePart):
+            continue
+        count += 1
+        for name in node_attributes(node):
+            stack.append(getattr(node, name, None))
+    return count
+
+
+def _measure_memory(shape, size):
+    # Runs in a fresh interpreter, so the peak resident set size belongs to this parse only.
+    # tracemalloc gives the python heap used by the parse tree and the peak during the parse
+    source = generate_source(size * 1024, shape)
+    gc.collect()
+    tracemalloc.start()
+    obfuscator = CppCodeObfuscator(source, seed=0)
+    obfuscator.parse()
+    obfuscator.memo = obfuscator.context = None
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is in kilobytes on linux and in bytes on mac os
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'tree_mb': current / 2 ** 20,
+        'peak_mb': peak / 2 ** 20,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20,
+        'nodes': _count_nodes(obfuscator.code_elements),
+    }
+
+
+def measure_memory(shape, size):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_measure_memory, (shape, size))
+
+
+def scaling_exponent(sizes, seconds):
+    # Slope of log(time) over log(size): about 1 for linear work, 2 for quadratic
+    points = [(math.log(size), math.log(sec)) for size, sec in zip(sizes, seconds) if sec > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if not variance:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def run(shapes, sizes, repeat=3, memory=False, **kwargs):
+    # Best of repeat seconds per stage for every shape and size, with memory also heap and peak RSS of the parse
+    results = {
+        'python': platform.python_version(),
+        'sizes_kb': sizes,
+        'shapes': {},
+    }
+    for shape in shapes:
+        runs = []
+        for size in sizes:
+            source = generate_source(size * 1024, shape)
+            best = {}
+            for _ in range(repeat):
+                for stage, sec in _time_run(source, **kwargs).items():
+                    best[stage] = min(best.get(stage, sec), sec)
+            if memory:
+                best.update(measure_memory(shape, size))
+            runs.append({'size_kb': size, 'chars': len(source), **best})
+        results['shapes'][shape] = {
+            'runs': runs,
+            'exponents': {
+                stage: scaling_exponent([r['chars'] for r in runs], [r[stage] for r in runs]) for stage in STAGES
+            },
+        }
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    # Returns messages for every stage at least threshold slower than in baseline
+    regressions = []
+    for shape, data in results['shapes'].items():
+        base_runs = {r['size_kb']: r for r in baseline.get('shapes', {}).get(shape, {}).get('runs', [])}
+        for current in data['runs']:
+            base = base_runs.get(current['size_kb'])
+            if base is None:
+                continue
+            for stage in STAGES + MEMORY:
+                if stage not in base or stage not in current:
+                    continue
+                if base[stage] > 0 and current[stage] > base[stage] * (1 + threshold):
+                    regressions.append(f'{shape} {current["size_kb"]}k {stage}: '
+                                       f'{base[stage]:.4f} -> {current[stage]:.4f} '
+                                       f'(+{(current[stage] / base[stage] - 1) * 100:.0f}%)')
+    return regressions
+
+
+def format_results(results):
+    memory = any('peak_rss_mb' in r for data in results['shapes'].values() for r in data['runs'])
+    lines = [f'{"shape":<10} {"size":>7} ' + ' '.join(f'{stage:>10}' for stage in STAGES) + f' {"MB/s":>8}' +
+             (' '.join(f' {column:>11}' for column in MEMORY) + f' {"nodes":>9}' if memory else '')]
+    for shape, data in results['shapes'].items():
+        for r in data['runs']:
+            total = sum(r[stage] for stage in STAGES)
+            speed = r['chars'] / 2 ** 20 / total if total else 0
+            lines.append(f'{shape:<10} {str(r["size_kb"]) + "k":>7} ' +
+                         ' '.join(f'{r[stage]:>10.4f}' for stage in STAGES) + f' {speed:>8.2f}' +
+                         (' '.join(f' {r[column]:>11.2f}' for column in MEMORY) + f' {r["nodes"]:>9}'
+                          if 'peak_rss_mb' in r else ''))
+        exponents = ', '.join(f'{stage} {value:.2f}' for stage, value in data['exponents'].items()
+                              if value is not None)
+        lines.append(f'{shape:<10} scaling exponent: {exponents}')
+    return '\n'.join(lines)
+
+
+parser = argparse.ArgumentParser(description='Benchmark parse, refactor and write stages on synthetic c++ sources')
+parser.add_argument('--sizes', metavar='KB', type=int, nargs='+', default=[16, 64, 256],
+                    help='Sizes of generated sources in kilobytes')
+parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=list(SHAPES), help='Shapes of generated code')
+parser.add_argument('--repeat', type=int, default=3, help='Runs per size, the best one is taken')
+parser.add_argument('--memo-size', metavar='entries', type=int, default=None,
+                    help='Max packrat memo entries, 0 disables memoization')
+parser.add_argument('--memory', action='store_true',
+                    help='Also measure memory of the parse tree, peak heap and RSS of the parse in a fresh process')
+parser.add_argument('-o', metavar='output', default=None, help='Save results as json')
+parser.add_argument('--baseline', metavar='json', default=None,
+                    help='Compare with saved results, exit code 1 on regressions')
+parser.add_argument('--threshold', type=float, default=0.1,
+                    help='Relative slowdown reported as regression. Default 0.1')
+
+
+def main(args):
+    kwargs = {} if args.memo_size is None else {'memo_size': args.memo_size}
+    results = run(args.shapes, args.sizes, args.repeat, args.memory, **kwargs)
+    print(format_results(results))
+
+    if args.o:
+        with open(args.o, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,146 @@
+import os
+
+from code_obfuscator import CppCodeObfuscator, write_fragments
+from lang_objects import CRawText
+
+# Kinds of the pieces of output
+TRIVIA = 0
+ELEMENT = 1
+# Run of tokens no rule recognized, runs on both sides of a split point are one run in the serial parse
+RAW = 2
+# Element given up over the parse budget
+DEGRADED = 3
+
+
+def split_points(tokens, chunk_size):
+    # Source offsets of tokens starting top level statements, about chunk_size characters apart. The statements are
+    # found on the token stream, so braces in strings and comments do not count
+    points = []
+    last = 0
+    index = 0
+    while index < len(tokens):
+        index = tokens.statement_end(index)
+        if index < len(tokens) and tokens.starts[index] - last >= chunk_size:
+            last = tokens.starts[index]
+            points.append(last)
+    return points
+
+
+def _pieces(obfuscator, spans, degraded):
+    # (start, end, kind, output) of every span
+    pieces = []
+    for start, end, part in spans:
+        if isinstance(part, str):
+            kind = TRIVIA
+        elif type(part) is CRawText:
+            kind = DEGRADED if start in degraded else RAW
+        else:
+            kind = ELEMENT
+        pieces.append((start, end, kind, ''.join(obfuscator.emit_span(start, end, part))))
+    return pieces
+
+
+def _parse_pieces(obfuscator, start, end):
+    # Parses and refactors [start, end) of the source, returns the pieces and (start, end, steps) of degraded elements
+    spans, degraded = obfuscator.parse_range(start, end)
+    return _pieces(obfuscator, spans, {item[0] for item in degraded}), degraded
+
+
+_worker = None
+
+
+def _init_worker(source, kwargs, compiled_grammar):
+    # Every worker lexes the whole source once, chunks are parsed on that token stream, so an element may run past
+    # the end of its chunk as it would in the serial parse
+    global _worker
+    if compiled_grammar:
+        import grammar_compiler
+        grammar_compiler.install()
+    _worker = CppCodeObfuscator(source, **kwargs)
+
+
+def _parse_chunk(start, end):
+    return _parse_pieces(_worker, start, end)
+
+
+def _stitch(output, pieces, source):
+    # Appends pieces, a raw run meeting the raw run before it across trivia becomes one run
+    for piece in pieces:
+        if piece[2] == RAW:
+            last = len(output) - 1
+            while last >= 0 and output[last][2] == TRIVIA:
+                last -= 1
+            if last >= 0 and output[last][2] == RAW:
+                start = output[last][0]
+                del output[last:]
+                output.append((start, piece[1], RAW, source[start:piece[1]]))
+                continue
+        output.append(piece)
+
+
+def _append_chunk(obfuscator, output, pos, chunk, degraded, chunk_end):
+    # Appends the pieces of a chunk parsed from its first token to the output ending at pos. Where the output ran past
+    # the start of the chunk the source is parsed here from pos until the parse lands on the start of an element of the
+    # chunk, from there on the chunk is what the serial parse would give. Returns the end of the output
+    source = obfuscator.source_code
+    pieces, chunk_degraded = chunk
+    while True:
+        index = 0
+        while index < len(pieces) and (pieces[index][0] < pos or pieces[index][2] == TRIVIA):
+            index += 1
+        target = pieces[index][0] if index < len(pieces) else chunk_end
+        if pos >= target:
+            break
+        parsed, parsed_degraded = _parse_pieces(obfuscator, pos, target)
+        _stitch(output, parsed, source)
+        degraded += parsed_degraded
+        pos = parsed[-1][1]
+        if pos == target:
+            break
+    if index < len(pieces):
+        _stitch(output, pieces[index:], source)
+        degraded += [item for item in chunk_degraded if item[0] >= pieces[index][0]]
+        pos = output[-1][1]
+    return pos
+
+
+def obfuscate_chunks(obfuscator, stream, chunk_size, jobs=None, compiled_grammar=False):
+    # Splits the source at top level statements, parses and refactors the chunks in worker processes and writes the
+    # output in order. With a seed the output is the same as the output of the serial parse.
+    # Returns (start, end, steps) of degraded elements
+    source = obfuscator.source_code
+    tokens = obfuscator.context.token_stream(source)
+    bounds = [0] + split_points(tokens, chunk_size) + [len(source)]
+    chunks = list(zip(bounds, bounds[1:]))
+    kwargs = {'memo_size': obfuscator.memo.max_entries if obfuscator.memo else 0, 'seed': obfuscator.seed,
+              'settings': obfuscator.settings}
+    if obfuscator.budget is not None:
+        kwargs.update(max_steps=obfuscator.budget.max_steps, max_seconds=obfuscator.budget.max_seconds)
+
+    if len(chunks) == 1 or jobs == 1:
+        results = (_parse_pieces(obfuscator, start, end) for start, end in chunks)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count() or 1, len(chunks)),
+                                       initializer=_init_worker, initargs=(source, kwargs, compiled_grammar))
+        results = executor.map(_parse_chunk, *zip(*chunks))
+
+    output = []
+    degraded = []
+    pos = 0
+    try:
+        for chunk, (_, chunk_end) in zip(results, chunks):
+            pos = _append_chunk(obfuscator, output, pos, chunk, degraded, chunk_end)
+            # Pieces are written once no raw run can grow into them any more
+            ready = len(output)
+            while ready and output[ready - 1][2] in (TRIVIA, RAW):
+                ready -= 1
+            write_fragments(stream, (piece[3] for piece in output[:ready]))
+            del output[:ready]
+        write_fragments(stream, (piece[3] for piece in output))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return degraded
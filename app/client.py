@@ -0,0 +1,155 @@
+#!/bin/python3
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+from batch import BatchReport, collect_sources, is_batch
+from protocol import default_socket_path, encode_frame, recv_frame
+
+# Requests sent ahead of the responses read in batch mode
+WINDOW = 8
+
+parser = argparse.ArgumentParser(description='Obfuscate c++ code with a running server.py, same usage as main.py')
+parser.add_argument('paths', nargs='+', metavar='filename',
+                    help='Input *.cpp filename. Several files, directories or glob patterns run a batch')
+parser.add_argument('-o', metavar='output', default=None,
+                    help='Output code filename. Default a.cpp. In batch mode output directory, default obfuscated',
+                    required=False)
+parser.add_argument('--memo-size', metavar='entries', type=int, default=None,
+                    help='Max packrat memo entries, 0 disables memoization', required=False)
+parser.add_argument('--seed', metavar='seed', default=None,
+                    help='Seed for reproducible output', required=False)
+parser.add_argument('--socket', metavar='path', default=default_socket_path(),
+                    help=f'Unix socket of the server. Default {default_socket_path()}', required=False)
+parser.add_argument('--no-fallback', action='store_true',
+                    help='Fail when the server is not running instead of obfuscating in this process',
+                    required=False)
+
+
+class ObfuscationClient:
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self._next_id = 0
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, source, name=None, seed=None, memo_size=None, op='obfuscate'):
+        # Returns the request id, responses come in the order of requests
+        self._next_id += 1
+        self.sock.sendall(encode_frame({'id': self._next_id, 'op': op, 'source': source, 'name': name,
+                                        'seed': seed, 'memo_size': memo_size}))
+        return self._next_id
+
+    def receive(self):
+        # Returns (obfuscated code, None) or (None, error)
+        response = recv_frame(self.sock)
+        return response.get('code'), response.get('error')
+
+    def obfuscate(self, source, **kwargs):
+        self.send(source, **kwargs)
+        return self.receive()
+
+
+def _read(filename):
+    with open(filename, 'r') as f:
+        return f.read()
+
+
+def _write(filename, code):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(code)
+
+
+def run_single(client, args):
+    src = args.paths[0]
+    code, error = client.obfuscate(_read(src), name=os.path.abspath(src), seed=args.seed,
+                                   memo_size=args.memo_size)
+    if error:
+        print(f'{src}: {error}')
+        sys.exit(1)
+    _write(args.o or 'a.cpp', code)
+
+
+def run_batch(client, args):
+    output_dir = args.o or 'obfuscated'
+    report = BatchReport()
+    start = time.perf_counter()
+    pending = []
+
+    def receive():
+        src, dst, size = pending.pop(0)
+        code, error = client.receive()
+        if not error:
+            try:
+                _write(dst, code)
+            except OSError as e:
+                error = f'{type(e).__name__}: {e}'
+        report.add(src, size, error)
+
+    try:
+        sources = collect_sources(args.paths)
+    except ValueError as e:
+        parser.error(str(e))
+    for src, relative in sources:
+        try:
+            source = _read(src)
+        except (OSError, UnicodeDecodeError) as e:
+            report.add(src, 0, f'{type(e).__name__}: {e}')
+            continue
+        client.send(source, name=os.path.abspath(src), seed=args.seed, memo_size=args.memo_size)
+        pending.append((src, os.path.join(output_dir, relative), os.path.getsize(src)))
+        if len(pending) >= WINDOW:
+            receive()
+    while pending:
+        receive()
+    report.seconds = time.perf_counter() - start
+
+    for src, error in report.failures:
+        print(f'{src}: {error}')
+    print(report.summary())
+    if report.failures:
+        sys.exit(1)
+
+
+def _fallback(args):
+    # Same work in this process, as main.py would do it
+    import main
+
+    argv = list(args.paths)
+    for flag, value in (('-o', args.o), ('--seed', args.seed), ('--memo-size', args.memo_size)):
+        if value is not None:
+            argv += [flag, str(value)]
+    main.main(main.parser.parse_args(argv))
+
+
+def main(args):
+    try:
+        client = ObfuscationClient(args.socket)
+    except OSError as e:
+        if args.no_fallback:
+            print(f'server is not available on {args.socket}: {e}')
+            sys.exit(1)
+        _fallback(args)
+        return
+
+    try:
+        if is_batch(args.paths):
+            run_batch(client, args)
+        else:
+            run_single(client, args)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
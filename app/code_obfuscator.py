@@ -1,48 +1,355 @@
+import os
+import random
+import re
+
+import lang_objects
+import lexer
+import parser_utils
 from lang_objects import *
+from config import DEFAULT_SETTINGS, ObfuscatorSettings
+from exceptions import BudgetExceeded
+from refactor_cache import RefactorCache, align_spans, span_digest
+
+
+_grammar_version = None
+
+
+def grammar_version():
+    # Hash of the grammar sources, anything stored for another grammar is not reused.
+    # Computed on first use, runs without a cache do not read the sources at start
+    global _grammar_version
+    if _grammar_version is None:
+        import hashlib
+        digest = hashlib.sha1()
+        for module in (lexer, parser_utils, lang_objects):
+            with open(module.__file__, 'rb') as f:
+                digest.update(f.read())
+        _grammar_version = digest.hexdigest()
+    return _grammar_version
+
+
+def __getattr__(name):
+    if name == 'GRAMMAR_VERSION':
+        return grammar_version()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def first_pattern(templates):
+    # Regex over TokenStream.firsts matching tokens one of templates can start with, None if any can start anywhere
+    first = first_of(templates)
+    if first is None:
+        return None
+    return re.compile('[' + ''.join(map(re.escape, sorted(first))) + ']')
 
 
 class CppCodeObfuscator:
-    c_elements = [
-        CSpaces,
+    structured_elements = [
         CInclude,
         CClass,
         CFunction,
         CVariableInit,
-        CWord,
-        CSymbol
     ]
+    # Fallbacks taking one token where nothing else fits, runs of them become one CRawText span
+    raw_elements = (CWord, CSymbol)
+    c_elements = structured_elements + list(raw_elements)
+
+    dispatcher = Dispatcher(c_elements)
+    # Finds the next token a structured element can start with, the tokens before it are raw text without trying
+    # any rule
+    structured_start = first_pattern(structured_elements)
 
-    def __init__(self, source_code):
+    def __init__(self, source_code, memo_size=PackratCache.DEFAULT_MAX_ENTRIES, seed=None, cache=None, name=None,
+                 profiler=None, tree_cache=None, max_steps=None, max_seconds=None, settings=None, rng=None,
+                 symbols=None):
         self.source_code = source_code
+        # ObfuscatorSettings read by parsing and refactoring, the defaults from config when None
+        self.settings = settings if settings is not None else DEFAULT_SETTINGS
+        # random.Random of this obfuscator, refactoring never touches the module wide random stream, so obfuscators
+        # can run in threads side by side
+        self.random = rng if rng is not None else random.Random()
         self.code_elements = []
         self.processed_code = ""
+        # memo_size=0 disables packrat memoization
+        self.memo = PackratCache(memo_size) if memo_size else None
+        # RuleProfiler collecting per rule statistics of the parse
+        self.profiler = profiler
+        # A top level element taking more than max_steps memoized rule applications or max_seconds to parse is given
+        # up and passed through as it is, see degraded
+        self.budget = ParseBudget(max_steps, max_seconds) if max_steps or max_seconds else None
+        self.context = ParseContext(self.memo, profiler, self.budget, self.settings)
+        # With a seed every top level element is refactored with its own random stream, derived from the seed and
+        # the element source, so the output does not depend on which elements were taken from the cache
+        self.seed = seed
+        # RefactorCache, name identifies the source between runs for incremental parsing
+        self.cache = cache
+        self.name = name
+        # TreeCache of parsed sources, a source parsed before with the same grammar is loaded instead of parsed
+        self.tree_cache = tree_cache
+        # SymbolIndex of the project, identifiers found in it are renamed in the output of the elements
+        self.symbols = symbols
+        # (start, end, element or its cached output) for every top level element, whitespace and comments between
+        # elements are spans of their text
+        self.spans = []
 
     @classmethod
-    def from_file(cls, filename):
+    def from_file(cls, filename, **kwargs):
+        kwargs.setdefault('name', os.path.abspath(filename))
         with open(filename, 'r') as f:
-            return CppCodeObfuscator(f.read())
+            return CppCodeObfuscator(f.read(), **kwargs)
 
     def print(self):
-        pprint(list(filter(lambda x: not isinstance(x, CSpaces), self.code_elements)))
+        from pprint import pprint
+        pprint(self.code_elements)
+
+    def parse(self):
+        if self.cache is None or self.tree_cache is not None:
+            # The stored tree has to be complete, elements taken from the refactor cache are output, not nodes
+            self.spans = self._parse_spans(self.source_code, self.context)
+        else:
+            self.spans = self._parse_incremental()
+        self.use_spans(self.spans)
+        # A tree with degraded elements depends on the budget, not only on the source and the grammar
+        if self.tree_cache is not None and not self.degraded:
+            self.tree_cache.store(self.source_code, self.spans, self.tree_version())
+
+    def parse_range(self, start, end):
+        # Parses the elements whose first token starts in [start, end) of the source, the last one may run past end.
+        # Returns their spans, not kept in self.spans, and (start, end, steps) of the degraded elements among them
+        count = len(self.degraded)
+        spans = self._parse_spans(self.source_code, self.context, start, end)
+        return spans, self.degraded[count:]
+
+    @property
+    def degraded(self):
+        # (start, end, steps) of the elements over the parse budget or nested too deep, passed through as they are
+        return self.context.degraded
+
+    def degraded_report(self, name=None, degraded=None):
+        # One line per degraded element: where it is and how much work was spent before it was given up
+        name = name or self.name or '<source>'
+        report = []
+        for start, end, steps in self.degraded if degraded is None else degraded:
+            line = self.source_code.count('\n', 0, start) + 1
+            reason = 'nested too deep to parse' if steps is None else f'parse budget exceeded after {steps} steps'
+            report.append(f'{name}:{line}: {reason}, {end - start} characters passed through unchanged')
+        return report
+
+    def load_tree(self):
+        # Takes the parse tree from the tree cache, then emit() refactors it right away. False on a miss
+        if self.tree_cache is None:
+            return False
+        spans = self.tree_cache.load(self.source_code, self.tree_version())
+        if spans is None:
+            return False
+        self.use_spans(spans)
+        return True
+
+    def tree_version(self):
+        # Key words change the parse, trees parsed with other key words are stored under a version of their own
+        if self.settings.key_words == DEFAULT_SETTINGS.key_words:
+            return grammar_version()
+        return span_digest(f'{grammar_version()}:{" ".join(sorted(self.settings.key_words))}')
+
+    def use_spans(self, spans):
+        # Takes spans parsed elsewhere, emit() only reads them, so one parse serves many emissions with different seeds
+        self.spans = spans
+        self.code_elements = [part for _, _, part in spans if isinstance(part, CodePart)]
 
     def obfuscate(self):
-        code = self.source_code
-        code_elements = self._parse(code)
+        if not self.load_tree():
+            self.parse()
+        self.processed_code = ''.join(self.emit())
+
+    # Parses and writes the obfuscated code to a text stream fragment by fragment,
+    # without building processed_code
+    def obfuscate_to(self, stream):
+        if not self.load_tree():
+            self.parse()
+        write_fragments(stream, self.emit())
+
+    def emit(self):
+        cache = self.cache
+        salt = self._cache_salt() if cache is not None else None
+        for start, end, part in self.spans:
+            yield from self.emit_span(start, end, part, salt)
 
-        self.processed_code = ''.join(map(lambda x: x.refactor(), code_elements))
+        if cache is not None:
+            if self.name is not None:
+                cache.save_manifest(self.name, [
+                    [end - start, span_digest(self.source_code[start:end])] for start, end, _ in self.spans
+                ])
+            cache.commit()
+
+    def emit_span(self, start, end, part, salt=None):
+        # Fragments of one span. With a seed they depend only on the text of the span, not on where it is
+        if isinstance(part, str):
+            yield part
+            return
+
+        cache = self.cache
+        digest = None
+        if self.seed is not None:
+            digest = span_digest(self.source_code[start:end])
+            self.random.seed(f'{self.seed}:{digest}')
+
+        # Raw text is not refactored, it may also be an element degraded by the budget of this run
+        if cache is None or end - start < cache.MIN_CACHED_LENGTH or type(part) is CRawText:
+            yield from self._fragments(part)
+            return
+
+        key = cache.key(salt, digest or span_digest(self.source_code[start:end]))
+        output = cache.get(key)
+        if output is None:
+            output = ''.join(self._fragments(part))
+            cache.put(key, output)
+        yield output
+
+    def _fragments(self, part):
+        output = fragments(part, settings=self.settings, rng=self.random)
+        if self.symbols is None:
+            return output
+        # Identifiers are renamed in the whole output of the element at once, small fragments cost more to look through
+        return [self.symbols.rename(''.join(output))]
 
     def write_file(self, filename):
         with open(filename, 'w') as f:
             f.write(self.processed_code)
 
+    def _cache_salt(self):
+        return RefactorCache.salt(grammar_version(), self.settings.as_dict(), self.seed,
+                                  self.symbols.digest if self.symbols is not None else None)
+
+    def _reuse_span(self, start, end, salt):
+        if end - start >= self.cache.MIN_CACHED_LENGTH:
+            output = self.cache.get(self.cache.key(salt, span_digest(self.source_code[start:end])))
+            if output is not None:
+                return [(start, end, output)]
+        return self._parse_spans(self.source_code, self.context, start, end)
+
+    def _parse_incremental(self):
+        code = self.source_code
+        manifest = self.cache.load_manifest(self.name) if self.name is not None else None
+        prefix, suffix = align_spans(code, manifest) if manifest else ([], [])
+        # A suffix span is the same text as before, but it is lexed the same only if the lexer enters it in its
+        # initial state. An edit opening a comment or a preprocessor line before it changes its tokens
+        tokens = self.context.token_stream(code)
+        while suffix and not tokens.is_neutral(suffix[0][0]):
+            suffix.pop(0)
+        salt = self._cache_salt()
+
+        spans = []
+        for start, end in prefix:
+            spans += self._reuse_span(start, end, salt)
+
+        # Everything between the unchanged prefix and suffix is parsed. An element may run into the suffix,
+        # then parsing goes on until it lands on the start of a suffix span again
+        pos = prefix[-1][1] if prefix else 0
+        suffix_index = 0
+        while True:
+            while suffix_index < len(suffix) and suffix[suffix_index][0] < pos:
+                suffix_index += 1
+            end = suffix[suffix_index][0] if suffix_index < len(suffix) else len(code)
+            if pos >= end:
+                break
+            parsed = self._parse_spans(code, self.context, pos, end)
+            spans += parsed
+            pos = parsed[-1][1]
+
+        for start, end in suffix[suffix_index:]:
+            spans += self._reuse_span(start, end, salt)
+        return spans
+
     @classmethod
-    def _parse(cls, code):
-        iterator = StrIterator(code, 0)
-        code_elements = []
-        while not iterator.is_end():
-            for CPart in cls.c_elements:
-                c_part = CPart.parse(iterator)
-                if c_part:
-                    code_elements.append(c_part)
-                    break
-        return code_elements
+    def _parse(cls, code, context=None):
+        return [element for _, _, element in cls._parse_spans(code, context)]
+
+    @classmethod
+    def _parse_spans(cls, code, context=None, start=0, end=None):
+        # Elements whose first token starts in [start, end), the trivia up to end is the last span
+        if end is None:
+            end = len(code)
+        iterator = StrIterator(code, context=context)
+        tokens = iterator.tokens
+        firsts = tokens.firsts
+        memo = iterator.context.memo
+        budget = iterator.context.budget
+        iterator.index = tokens.next_token(start)
+        last = tokens.next_token(end)
+        pos = start
+        spans = []
+        # First token of the raw text run before the cursor, or None
+        raw = None
+        while iterator.index < last:
+            begin = iterator.index
+            if cls.structured_start is not None:
+                match = cls.structured_start.search(firsts, begin, last)
+                skip_to = match.start() if match else last
+                if skip_to > begin:
+                    if raw is None:
+                        raw = begin
+                    iterator.index = skip_to
+                    continue
+
+            if budget is not None:
+                budget.start()
+            try:
+                for CPart in cls.dispatcher.candidates(firsts[begin]):
+                    c_part = CPart.parse(iterator)
+                    if c_part:
+                        break
+            except (BudgetExceeded, RecursionError) as e:
+                # The element is given up up to the end of its statement, the text goes out as it is. Rules that
+                # are not written as steps recurse in python, such as CType over unbalanced < of template arguments
+                iterator.index = tokens.statement_end(begin)
+                iterator.context.degraded.append((tokens.starts[begin], tokens.ends[iterator.index - 1],
+                                                  getattr(e, 'steps', None)))
+                c_part = CRawText
+            if type(c_part) in cls.raw_elements:
+                # Failed attempts of the run stay memorized, the next token is tried over the same text
+                if raw is None:
+                    raw = begin
+                continue
+
+            if raw is not None:
+                pos = cls._append_span(spans, code, pos, tokens, raw, begin, CRawText)
+                raw = None
+            pos = cls._append_span(spans, code, pos, tokens, begin, iterator.index, c_part)
+            # Top level elements never look back, memorized results behind the cursor are useless
+            if memo is not None:
+                memo.clear()
+        if raw is not None:
+            pos = cls._append_span(spans, code, pos, tokens, raw, iterator.index, CRawText)
+        if memo is not None:
+            memo.clear()
+        if pos < end:
+            spans.append((pos, end, code[pos:end]))
+        return spans
+
+    @staticmethod
+    def _append_span(spans, code, pos, tokens, begin, index, part):
+        # Appends the trivia before token begin and the element of tokens [begin, index), part is the element or the
+        # rule of raw text. Returns the end of the element
+        element_start = tokens.starts[begin]
+        element_end = tokens.ends[index - 1]
+        if pos < element_start:
+            spans.append((pos, element_start, code[pos:element_start]))
+        if part is CRawText:
+            part = CRawText.__new__(CRawText)
+            part.set_span(code, element_start, element_end)
+        spans.append((element_start, element_end, part))
+        return element_end
+
+
+def obfuscate_many(obfuscators, max_workers=None):
+    # Runs obfuscate() of every obfuscator in a thread pool, returns the processed code in the order of obfuscators.
+    # Obfuscators share no state but the interned rules, each one has its own settings and random.Random, so with seeds
+    # or seeded rngs the output does not depend on how the threads interleave. A RefactorCache or TreeCache must not be
+    # shared between obfuscators of one call
+    from concurrent.futures import ThreadPoolExecutor
+
+    obfuscators = list(obfuscators)
+    if not obfuscators:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers or os.cpu_count() or 1, len(obfuscators))) as executor:
+        list(executor.map(CppCodeObfuscator.obfuscate, obfuscators))
+    return [obfuscator.processed_code for obfuscator in obfuscators]
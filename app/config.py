@@ -1,3 +1,5 @@
+from constants import INDENT
+
 key_words = [
     'class', 'for', 'if', 'else', 'public', 'private', 'while', 'do', 'struct'
 ]
@@ -7,3 +9,24 @@ file_name = 'code.cpp'
 obfuscator_settings = {
     "indent": 4
 }
+
+
+# Settings of one obfuscator. The module values above are only the defaults, they are read here once, so obfuscators
+# with other settings can run side by side in one process
+class ObfuscatorSettings:
+    __slots__ = ('indent', 'key_words')
+
+    def __init__(self, indent=obfuscator_settings[INDENT], key_words=tuple(key_words)):
+        self.indent = indent
+        # Words that are never taken for a type name
+        self.key_words = frozenset(key_words)
+
+    def as_dict(self):
+        # Part of the refactor cache key
+        return {INDENT: self.indent, 'key_words': sorted(self.key_words)}
+
+    def __repr__(self):
+        return f'ObfuscatorSettings(indent={self.indent!r}, key_words={sorted(self.key_words)!r})'
+
+
+DEFAULT_SETTINGS = ObfuscatorSettings()
@@ -0,0 +1,151 @@
+#!/bin/python3
+
+import argparse
+import os
+import random
+
+# Synthetic C++ sources for benchmarks. Every shape only uses constructions the grammar understands
+SHAPES = ('mixed', 'classes', 'functions', 'nesting', 'templates')
+
+TYPES = ('int', 'long', 'double', 'char', 'bool', 'string')
+
+
+def _name(rng, prefix):
+    return f'{prefix}{rng.randrange(10 ** 6)}'
+
+
+def _type(rng):
+    return rng.choice(TYPES)
+
+
+def _template_type(rng, depth):
+    if depth <= 0 or rng.random() < 0.3:
+        return _type(rng)
+    args = ', '.join(_template_type(rng, depth - 1) for _ in range(rng.randint(1, 2)))
+    return f'{rng.choice(("vector", "map", "set", "pair"))}<{args}>'
+
+
+def _expression(rng):
+    return ' + '.join(f'({_name(rng, "v")} * {rng.randrange(100)})' for _ in range(rng.randint(1, 3)))
+
+
+# Characters an element may still take, shared by its nested statements. Statements are not started when it is
+# used up, so the size of an element follows the size asked for and not the product of its counts and depth
+class _Budget:
+    def __init__(self, left):
+        self.left = left
+
+    def add(self, lines, line):
+        lines.append(line)
+        self.left -= len(line) + 1
+
+
+def _statements(rng, depth, count, indent, budget):
+    pad = ' ' * indent
+    lines = []
+    for _ in range(count):
+        if budget.left <= 0:
+            break
+        kind = rng.random()
+        if depth > 0 and kind < 0.3:
+            budget.add(lines, f'{pad}if ({_expression(rng)} > {rng.randrange(100)}) {{')
+            lines += _statements(rng, depth - 1, max(1, count // 2), indent + 4, budget)
+            budget.add(lines, f'{pad}}} else {{')
+            lines += _statements(rng, depth - 1, 1, indent + 4, budget)
+            budget.add(lines, f'{pad}}}')
+        elif depth > 0 and kind < 0.5:
+            i = _name(rng, 'i')
+            budget.add(lines, f'{pad}for (int {i} = 0; {i} < {rng.randrange(100)}; ++{i}) {{')
+            lines += _statements(rng, depth - 1, max(1, count // 2), indent + 4, budget)
+            budget.add(lines, f'{pad}}}')
+        else:
+            budget.add(lines, f'{pad}{_type(rng)} {_name(rng, "v")} = {_expression(rng)};')
+    return lines
+
+
+def _function(rng, depth, length, budget, type_depth=0):
+    args = ', '.join(f'{_template_type(rng, type_depth)} {_name(rng, "a")}' for _ in range(rng.randint(0, 3)))
+    lines = []
+    budget.add(lines, f'{_template_type(rng, type_depth)} {_name(rng, "f")}({args}) {{')
+    lines += _statements(rng, depth, length, 4, budget)
+    budget.add(lines, f'    return {_name(rng, "v")};')
+    budget.add(lines, '}')
+    return '\n'.join(lines) + '\n'
+
+
+def _class(rng, members, budget, type_depth=0):
+    name = _name(rng, 'C')
+    lines = []
+    budget.add(lines, f'class {name} {{')
+    budget.add(lines, 'public:')
+    budget.add(lines, f'    {name}(int {_name(rng, "a")}) {{')
+    lines += _statements(rng, 1, 2, 8, budget)
+    budget.add(lines, '    }')
+    for _ in range(members):
+        if budget.left <= 0:
+            break
+        if rng.random() < 0.5:
+            budget.add(lines, f'    {_template_type(rng, type_depth)} {_name(rng, "m")};')
+        else:
+            budget.add(lines, f'    {_type(rng)} {_name(rng, "get")}() const {{')
+            lines += _statements(rng, 1, 2, 8, budget)
+            budget.add(lines, '    }')
+    budget.add(lines, 'private:')
+    for _ in range(max(1, members // 2)):
+        budget.add(lines, f'    {_template_type(rng, type_depth)} {_name(rng, "p")};')
+        if budget.left <= 0:
+            break
+    budget.add(lines, '};')
+    return '\n'.join(lines) + '\n'
+
+
+# Largest element of every shape in characters, smaller sources get smaller elements
+ELEMENT_SIZES = {'classes': 4096, 'functions': 16384, 'nesting': 8192, 'templates': 2048}
+
+
+def _element(rng, shape, left):
+    if shape == 'mixed':
+        shape = rng.choice(SHAPES[1:])
+    budget = _Budget(min(left, ELEMENT_SIZES[shape]))
+    if shape == 'classes':
+        return _class(rng, rng.randint(4, 12), budget)
+    if shape == 'functions':
+        return _function(rng, 2, rng.randint(20, 60), budget)
+    if shape == 'nesting':
+        return _function(rng, 12, 2, budget)
+    return _function(rng, 1, 3, budget, type_depth=4) + f'{_template_type(rng, 5)} {_name(rng, "g")};\n'
+
+
+def generate_source(size, shape='mixed', seed=0):
+    # Source of about size characters
+    assert shape in SHAPES, shape
+    rng = random.Random(f'{shape}:{seed}')
+    parts = ['#include <vector>\n#include <map>\n#include <string>\n\n']
+    length = len(parts[0])
+    while length < size:
+        part = _element(rng, shape, size - length)
+        parts.append(part + '\n')
+        length += len(part) + 1
+    return ''.join(parts)
+
+
+parser = argparse.ArgumentParser(description='Generate synthetic c++ sources for benchmarks')
+parser.add_argument('directory', help='Output directory')
+parser.add_argument('--sizes', metavar='KB', type=int, nargs='+', default=[16, 64, 256],
+                    help='Sizes of generated files in kilobytes')
+parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=list(SHAPES), help='Shapes of generated code')
+parser.add_argument('--seed', type=int, default=0)
+
+
+def main(args):
+    os.makedirs(args.directory, exist_ok=True)
+    for shape in args.shapes:
+        for size in args.sizes:
+            filename = os.path.join(args.directory, f'{shape}_{size}k.cpp')
+            with open(filename, 'w') as f:
+                f.write(generate_source(size * 1024, shape, args.seed))
+            print(filename)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
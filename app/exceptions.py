@@ -1,3 +1,12 @@
 
 class NotFitException(Exception):
     pass
+
+
+# Raised by ParseBudget when a top level element took more parse steps or time than allowed. Not a NotFitException,
+# so no alternative catches it and the whole element is given up
+class BudgetExceeded(Exception):
+    def __init__(self, steps, seconds):
+        super().__init__(f'parse budget exceeded after {steps} steps, {seconds:.2f}s')
+        self.steps = steps
+        self.seconds = seconds
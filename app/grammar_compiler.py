@@ -0,0 +1,682 @@
+#!/bin/python3
+
+import argparse
+import ast
+import builtins
+import inspect
+import os
+import re
+import sys
+import tempfile
+import textwrap
+import time
+import types
+
+import lang_objects
+from code_obfuscator import CppCodeObfuscator, grammar_version
+from corpus_generator import SHAPES, generate_source
+from exceptions import NotFitException
+from parser_utils import ChoicePart, CodePart, RegexPart, all_rules, rule_name
+from refactor_cache import span_digest
+from tree_cache import encode_tree, resolve_rule
+
+# Compiles the rules of lang_objects into flat python functions, one match(cls, it) per rule. The compiler reads the
+# source of every __init__(self, it) written with fit, try_parse, have_item, fit_choice and try_fit blocks and writes
+# the same steps without the interpreter around them: leaf rules (words, symbols, regex tokens) are matched inline on
+# the token arrays, try_fit blocks become a saved index instead of a copied iterator and an exception, choices are
+# picked by the FIRST sets of the alternatives. Rules with other constructs keep their interpreted match.
+# The module is generated once per grammar and kept in a directory, install() puts its functions in place
+
+
+def _cache_home():
+    # Cache directory of the user, the package directory may be read only
+    if sys.platform == 'win32':
+        return os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    return os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+
+
+DEFAULT_DIRECTORY = os.path.join(_cache_home(), 'cpp-obfuscator', 'compiled_grammar')
+
+PARSE_CALLS = frozenset(('fit', 'try_parse', 'have_item', 'fit_choice', 'apply_rule'))
+# Factories of interned rules, called with constants they return the same rule every time
+INTERNED = frozenset(f.__func__ if hasattr(f, '__func__') else f for f in (
+    lang_objects.specific_symbol, lang_objects.specific_word, lang_objects.CClassSection.generate_class_section,
+))
+
+
+class Unsupported(Exception):
+    pass
+
+
+def compiled_version():
+    # Generated code depends on the grammar and on this compiler
+    with open(__file__, 'r') as f:
+        return span_digest(grammar_version() + f.read())
+
+
+class _Emitter:
+    def __init__(self, depth=0):
+        self.lines = []
+        self.depth = depth
+        self.counter = 0
+
+    def emit(self, line):
+        self.lines.append('    ' * self.depth + line)
+
+    def temp(self, prefix='v'):
+        self.counter += 1
+        return f'_{prefix}{self.counter}'
+
+
+# Names and helper functions shared by the generated functions
+class _Module:
+    def __init__(self):
+        self.imports = set()
+        self.constants = {}
+        self.constant_lines = []
+        self.functions = []
+        self.rules = {}
+        self.lists = {}
+
+    def constant(self, key, expression, prefix='c'):
+        name = self.constants.get(key)
+        if name is None:
+            name = self.constants[key] = f'_{prefix}{len(self.constants)}'
+            self.constant_lines.append(f'{name} = {expression}')
+        return name
+
+    def rule(self, rule):
+        return self.constant(('rule', rule), f'resolve_rule({rule_name(rule)!r})', 'r')
+
+    def pattern(self, pattern):
+        return self.constant(('pattern', pattern.pattern, pattern.flags),
+                             f're.compile({pattern.pattern!r}, {int(pattern.flags)})', 'p')
+
+    def first(self, first):
+        return self.constant(('first', first), f'frozenset({"".join(sorted(first))!r})', 'f')
+
+    def module_global(self, module, name):
+        self.imports.add(module)
+        return self.constant(('global', module, name), f'{module}.{name}', 'g')
+
+    def list_helper(self, item, sep):
+        # Function matching [item] separated by sep, the list or None
+        key = (item, sep)
+        name = self.lists.get(key)
+        if name is None:
+            name = self.lists[key] = f'_list{len(self.lists)}'
+            out = _Emitter(1)
+            out.emit('_tokens = it.tokens')
+            first = match_template(self, out, item)
+            out.emit(f'if {first} is None:')
+            out.emit('    return None')
+            out.emit(f'_items = [{first}]')
+            out.emit('while True:')
+            out.depth += 1
+            out.emit('_start = it.index')
+            if sep is not None:
+                separator = match_template(self, out, sep)
+                out.emit(f'if {separator} is None:')
+                out.emit('    break')
+            following = match_template(self, out, item)
+            out.emit(f'if {following} is None:')
+            out.emit('    it.index = _start')
+            out.emit('    break')
+            out.emit(f'_items.append({following})')
+            out.depth -= 1
+            out.emit('return _items')
+            self.functions.append(f'def {name}(it):\n' + '\n'.join(out.lines))
+        return name
+
+    def source(self, version, skipped):
+        header = [
+            f'# Generated by grammar_compiler.py from grammar {version}, do not edit',
+            '# Interpreted rules: ' + (', '.join(skipped) or 'none'),
+            'import re',
+            *(f'import {module}' for module in sorted(self.imports)),
+            'from parser_utils import match_choice, match_rule, match_text, try_parse',
+            'from tree_cache import resolve_rule',
+            '',
+            f'VERSION = {version!r}',
+        ]
+        rules = ['RULES = {'] + [f'    {name!r}: {function},' for name, function in self.rules.items()] + ['}']
+        return '\n'.join(header + self.constant_lines + [''] + [f'\n{f}\n' for f in self.functions] + rules) + '\n'
+
+
+def _leaf_text(rule):
+    # Text of the only token an interned or literal leaf rule matches, None for other rules
+    if 'node' in rule.__dict__:
+        return rule.__dict__.get('symbol') or rule.__dict__.get('word')
+    regex = rule.regex
+    if isinstance(regex, str) and regex and re.escape(regex) == regex:
+        return regex
+    return None
+
+
+def match_template(module, out, template, sep=None):
+    # Emits code matching a template known at compile time, returns the variable with the result or None
+    result = out.temp()
+    if isinstance(template, list):
+        if len(template) != 1:
+            raise Unsupported(template)
+        out.emit(f'{result} = {module.list_helper(template[0], sep)}(it)')
+        return result
+    if sep is not None:
+        raise Unsupported(sep)
+    if isinstance(template, (str, re.Pattern)):
+        out.emit(f'{result} = match_text(it, {module.pattern(re.compile(template))})')
+        return result
+    if not (isinstance(template, type) and issubclass(template, CodePart)):
+        raise Unsupported(template)
+
+    rule = module.rule(template)
+    plain_leaf = issubclass(template, RegexPart) and not template.memoize and (
+        template.match.__func__ is RegexPart.match.__func__ or 'node' in template.__dict__)
+    if not plain_leaf:
+        out.emit(f'{result} = match_rule(it, {rule})')
+        return result
+
+    index = out.temp('i')
+    out.emit(f'{index} = it.index')
+    text = _leaf_text(template)
+    if template.token_kind is not None and 'node' not in template.__dict__:
+        condition = f'_tokens.kinds[{index}] == {template.token_kind}'
+    elif text is not None:
+        condition = f'_tokens.firsts[{index}] == {text[0]!r} and _tokens.ends[{index}] - _tokens.starts[{index}] == ' \
+                    f'{len(text)}'
+        if len(text) > 1:
+            condition += f' and it.text.startswith({text!r}, _tokens.starts[{index}])'
+    else:
+        condition = f'_tokens.starts[{index}] != _tokens.ends[{index}] and {module.pattern(template.pattern)}' \
+                    f'.fullmatch(it.text, _tokens.starts[{index}], _tokens.ends[{index}]) is not None'
+    out.emit(f'if {condition}:')
+    out.depth += 1
+    if 'node' in template.__dict__:
+        out.emit(f'{result} = {rule}.node')
+    else:
+        out.emit(f'{result} = {rule}.__new__({rule})')
+        out.emit(f'{result}.source = it.text')
+        out.emit(f'{result}.start = _tokens.starts[{index}]')
+        out.emit(f'{result}.end = _tokens.ends[{index}]')
+    out.emit(f'it.index = {index} + 1')
+    out.depth -= 1
+    out.emit('else:')
+    out.emit(f'    {result} = None')
+    return result
+
+
+def match_alternatives(module, out, templates):
+    # Emits code of match_choice over rules known at compile time: alternatives are tried in order, skipping the ones
+    # whose FIRST set does not have the current token, like Dispatcher.candidates does
+    result = out.temp()
+    lookahead = out.temp('c')
+    out.emit(f'{lookahead} = _tokens.firsts[it.index]')
+    out.emit(f'{result} = None')
+    for i, template in enumerate(templates):
+        first = template.first if isinstance(template, type) and issubclass(template, CodePart) else None
+        conditions = [f'{result} is None'] if i else []
+        if first is not None:
+            conditions.append(f'{lookahead} in {module.first(first)}')
+        if conditions:
+            out.emit(f'if {" and ".join(conditions)}:')
+            out.depth += 1
+        value = match_template(module, out, template)
+        out.emit(f'{result} = {value}')
+        if conditions:
+            out.depth -= 1
+    return result
+
+
+def _contains_parse_call(node, aliases):
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and (
+                child.func.id in PARSE_CALLS or child.func.id in aliases):
+            return True
+    return False
+
+
+class _RuleCompiler(ast.NodeTransformer):
+    def __init__(self, module, rule):
+        self.module = module
+        self.rule = rule
+        init = rule.__dict__['__init__']
+        try:
+            source = textwrap.dedent(inspect.getsource(init))
+        except (OSError, TypeError) as e:
+            raise Unsupported(e)
+        self.function = ast.parse(source).body[0]
+        self.globals = init.__globals__
+        self.module_name = init.__module__
+        self.closure = dict(zip(init.__code__.co_freevars, (cell.cell_contents for cell in init.__closure__ or ())))
+        self.out = _Emitter(1)
+        # try_fit aliases in scope -> variable set when the block succeeded
+        self.aliases = {}
+        # Failure inside a try_fit block leaves the block, outside of it the rule
+        self.in_block = False
+
+    def compile(self, name):
+        args = [arg.arg for arg in self.function.args.args]
+        if args != ['self', 'it']:
+            raise Unsupported(args)
+        self.locals = {node.id for node in ast.walk(self.function) if isinstance(node, ast.Name)
+                       and isinstance(node.ctx, ast.Store)} | {'self', 'it'}
+        if any(name.startswith('_') for name in self.locals):
+            raise Unsupported('local names starting with _ are taken by generated code')
+        self.out.emit('_start = it.index')
+        self.out.emit('_tokens = it.tokens')
+        self.out.emit('self = cls.__new__(cls)')
+        for statement in self.function.body:
+            self.statement(statement)
+        self.out.emit('return self')
+        return f'def {name}(cls, it):\n' + '\n'.join(self.out.lines)
+
+    def fail(self):
+        if self.in_block:
+            self.out.emit('break')
+        else:
+            self.out.emit('it.index = _start')
+            self.out.emit('return None')
+
+    def fail_if_none(self, value):
+        self.out.emit(f'if {value} is None:')
+        self.out.depth += 1
+        self.fail()
+        self.out.depth -= 1
+
+    def statement(self, node):
+        out = self.out
+        if isinstance(node, ast.Pass):
+            return
+        if isinstance(node, ast.Expr):
+            value = self.expression(node.value)
+            if not isinstance(value, ast.Name):
+                out.emit(ast.unparse(value))
+        elif isinstance(node, (ast.Assign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if any(_contains_parse_call(target, self.aliases) for target in targets):
+                raise Unsupported(ast.unparse(node))
+            node.value = self.expression(node.value)
+            if isinstance(node, ast.Assign):
+                node.targets = [self.visit(target) for target in targets]
+            else:
+                node.target = self.visit(node.target)
+            out.emit(ast.unparse(node))
+        elif isinstance(node, ast.If):
+            test = self.expression(node.test)
+            out.emit(f'if {ast.unparse(test)}:')
+            self.block(node.body)
+            if node.orelse:
+                out.emit('else:')
+                self.block(node.orelse)
+        elif isinstance(node, ast.Raise):
+            exception = node.exc.func if isinstance(node.exc, ast.Call) else node.exc
+            if not isinstance(exception, ast.Name) or self._global(exception.id) is not NotFitException:
+                raise Unsupported(ast.unparse(node))
+            self.fail()
+        elif isinstance(node, ast.With):
+            self.try_fit_block(node)
+        else:
+            raise Unsupported(ast.unparse(node))
+
+    def block(self, statements):
+        self.out.depth += 1
+        length = len(self.out.lines)
+        for statement in statements:
+            self.statement(statement)
+        if len(self.out.lines) == length:
+            self.out.emit('pass')
+        self.out.depth -= 1
+
+    def try_fit_block(self, node):
+        # with try_fit(it) as f: the block runs once in a loop, a failure breaks out of it and restores the index
+        if len(node.items) != 1 or self.in_block:
+            raise Unsupported(ast.unparse(node))
+        item = node.items[0]
+        call = item.context_expr
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id == 'try_fit'
+                and len(call.args) == 1 and isinstance(call.args[0], ast.Name) and call.args[0].id == 'it'):
+            raise Unsupported(ast.unparse(node))
+        out = self.out
+        start = out.temp('s')
+        success = out.temp('ok')
+        out.emit(f'{start} = it.index')
+        out.emit(f'{success} = False')
+        out.emit('while True:')
+        out.depth += 1
+        alias = item.optional_vars.id if isinstance(item.optional_vars, ast.Name) else None
+        if alias is not None:
+            self.aliases[alias] = success
+        self.in_block = True
+        for statement in node.body:
+            self.statement(statement)
+        self.in_block = False
+        out.emit(f'{success} = True')
+        out.emit('break')
+        out.depth -= 1
+        out.emit(f'if not {success}:')
+        out.emit(f'    it.index = {start}')
+
+    def expression(self, node):
+        # Parse calls of the expression are emitted before it and replaced with their result variables
+        for child in ast.walk(node):
+            if isinstance(child, (ast.Lambda, ast.BoolOp, ast.IfExp, ast.ListComp, ast.SetComp, ast.DictComp,
+                                  ast.GeneratorExp)) and _contains_parse_call(child, self.aliases):
+                raise Unsupported(ast.unparse(node))
+        return self.visit(node)
+
+    def _global(self, name):
+        if name in self.closure:
+            return self.closure[name]
+        if name in self.globals:
+            return self.globals[name]
+        if hasattr(builtins, name):
+            return getattr(builtins, name)
+        raise Unsupported(name)
+
+    def static(self, node):
+        # Value of a template expression known at compile time, Unsupported otherwise
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return node.value
+        if isinstance(node, ast.List) and len(node.elts) == 1:
+            return [self.static(node.elts[0])]
+        if isinstance(node, ast.Name):
+            if node.id == 'self':
+                return self.rule
+            if node.id in self.locals:
+                raise Unsupported(node.id)
+            return self._global(node.id)
+        if isinstance(node, ast.Attribute):
+            value = self.static(node.value)
+            if not isinstance(value, (type, types.ModuleType)):
+                raise Unsupported(ast.unparse(node))
+            return getattr(value, node.attr)
+        if isinstance(node, ast.Call) and not node.keywords:
+            function = self.static(node.func)
+            arguments = [self.static(arg) for arg in node.args]
+            if getattr(function, '__func__', function) in INTERNED and all(isinstance(a, str) for a in arguments):
+                return function(*arguments)
+        raise Unsupported(ast.unparse(node))
+
+    def template(self, node, sep=None):
+        # Variable holding the match of a template expression, None on failure
+        try:
+            return match_template(self.module, self.out, self.static(node),
+                                  None if sep is None else self.static(sep))
+        except Unsupported:
+            # Built at run time, parsed as the interpreter would
+            result = self.out.temp()
+            arguments = ast.unparse(self.visit(node))
+            if sep is not None:
+                arguments += f', sep={ast.unparse(self.visit(sep))}'
+            self.out.emit(f'{result} = try_parse(it, {arguments})')
+            return result
+
+    def visit_Call(self, node):
+        function = node.func
+        if isinstance(function, ast.Name) and function.id in self.aliases:
+            return self._fit(node.args, node.keywords)
+        if isinstance(function, ast.Name) and function.id in PARSE_CALLS and function.id not in self.locals:
+            if not node.args or not isinstance(node.args[0], ast.Name) or node.args[0].id != 'it' or self.in_block:
+                raise Unsupported(ast.unparse(node))
+            name = function.id
+            arguments = node.args[1:]
+            if name in ('fit', 'apply_rule'):
+                return self._fit(arguments, node.keywords)
+            if name == 'try_parse':
+                return ast.Name(self._template_call(arguments, node.keywords))
+            if name == 'have_item':
+                value = self._template_call(arguments, node.keywords)
+                result = self.out.temp('h')
+                self.out.emit(f'{result} = {value} is not None')
+                return ast.Name(result)
+            # fit_choice
+            try:
+                templates = [self.static(argument) for argument in arguments]
+                if not all(isinstance(t, type) and issubclass(t, CodePart) for t in templates):
+                    raise Unsupported(templates)
+                value = match_alternatives(self.module, self.out, templates)
+            except Unsupported:
+                value = self.out.temp()
+                self.out.emit(f'{value} = match_choice(it, {", ".join(ast.unparse(self.visit(a)) for a in arguments)})')
+            self.fail_if_none(value)
+            return ast.Name(value)
+        # Constructor of a rule, Rule(it): the rule's own match without memo
+        if len(node.args) == 1 and isinstance(node.args[0], ast.Name) and node.args[0].id == 'it' \
+                and not node.keywords:
+            try:
+                rule = self.static(function)
+            except Unsupported:
+                rule = None
+            if isinstance(rule, type) and issubclass(rule, CodePart):
+                if self.in_block:
+                    raise Unsupported(ast.unparse(node))
+                value = self.out.temp()
+                self.out.emit(f'{value} = {self.module.rule(rule)}.match(it)')
+                self.fail_if_none(value)
+                return ast.Name(value)
+        return self.generic_visit(node)
+
+    def _template_call(self, arguments, keywords):
+        sep = None
+        for keyword in keywords:
+            if keyword.arg != 'sep':
+                raise Unsupported(keyword.arg)
+            sep = keyword.value
+        if len(arguments) == 2:
+            arguments, sep = arguments[:1], arguments[1]
+        if len(arguments) != 1:
+            raise Unsupported(arguments)
+        return self.template(arguments[0], sep)
+
+    def _fit(self, arguments, keywords):
+        value = self._template_call(arguments, keywords)
+        self.fail_if_none(value)
+        return ast.Name(value)
+
+    def visit_Attribute(self, node):
+        # f.success and f.fail of a try_fit block
+        if isinstance(node.value, ast.Name) and node.value.id in self.aliases and isinstance(node.ctx, ast.Load):
+            success = self.aliases[node.value.id]
+            if node.attr == 'success':
+                return ast.Name(success)
+            if node.attr == 'fail':
+                return ast.UnaryOp(ast.Not(), ast.Name(success))
+            raise Unsupported(ast.unparse(node))
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id in self.locals or not isinstance(node.ctx, ast.Load):
+            return node
+        if node.id in self.aliases:
+            raise Unsupported(node.id)
+        value = self._global(node.id)
+        if node.id in self.closure:
+            if not isinstance(value, (str, int, float, bool, type(None))):
+                raise Unsupported(node.id)
+            return ast.Constant(value)
+        if isinstance(value, type) and issubclass(value, CodePart):
+            return ast.Name(self.module.rule(value))
+        if hasattr(builtins, node.id) and node.id not in self.globals:
+            return node
+        return ast.Name(self.module.module_global(self.module_name, node.id))
+
+
+def _choice_function(module, rule, name):
+    out = _Emitter(1)
+    out.emit('_tokens = it.tokens')
+    value = match_alternatives(module, out, rule.choices)
+    out.emit(f'if {value} is None:')
+    out.emit('    return None')
+    out.emit('self = cls.__new__(cls)')
+    out.emit(f'self.value = {value}')
+    out.emit('return self')
+    return f'def {name}(cls, it):\n' + '\n'.join(out.lines)
+
+
+def _compilable(rule):
+    match = rule.__dict__.get('match')
+    if rule.__dict__.get('steps') is not None:
+        return None
+    if '__init__' in rule.__dict__ and isinstance(match, classmethod) and match.__func__ is CodePart.match.__func__:
+        return 'init'
+    if issubclass(rule, ChoicePart) and match is None and '__init__' not in rule.__dict__ \
+            and rule.match.__func__ is ChoicePart.match.__func__:
+        return 'choice'
+    return None
+
+
+def compile_grammar(version=None):
+    # Source of the compiled module and the names of rules left to the interpreter
+    module = _Module()
+    skipped = []
+    done = set()
+    while True:
+        # Compiling a rule may create interned rules, they are compiled in the next round
+        rules = [rule for rule in all_rules() if rule not in done]
+        if not rules:
+            break
+        for rule in sorted(rules, key=rule_name):
+            done.add(rule)
+            kind = _compilable(rule)
+            if kind is None:
+                continue
+            name = '_match_' + re.sub(r'\W', '_', rule_name(rule))
+            try:
+                if kind == 'init':
+                    function = _RuleCompiler(module, rule).compile(name)
+                else:
+                    function = _choice_function(module, rule, name)
+            except Unsupported:
+                skipped.append(rule_name(rule))
+                continue
+            module.functions.append(function)
+            module.rules[rule_name(rule)] = name
+    return module.source(version or compiled_version(), skipped), skipped
+
+
+def load(directory=DEFAULT_DIRECTORY):
+    # Compiled module of the current grammar, generated on first use and kept in directory
+    version = compiled_version()
+    filename = os.path.join(directory, f'grammar_{version[:16]}.py')
+    if not os.path.exists(filename):
+        source, _ = compile_grammar(version)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(source)
+            os.replace(temp, filename)
+            # Modules of older grammars are never loaded again
+            for name in os.listdir(directory):
+                if name.startswith('grammar_') and name.endswith('.py') and name != os.path.basename(filename):
+                    os.remove(os.path.join(directory, name))
+        except OSError:
+            # Read only directory, the module lives in memory
+            module = types.ModuleType(f'compiled_grammar_{version[:16]}')
+            exec(compile(source, filename, 'exec'), module.__dict__)
+            return module
+
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(f'compiled_grammar_{version[:16]}', filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Rule -> its match before install(), None if the rule inherited it
+_installed = {}
+
+
+def install(module=None):
+    # Parses with the compiled functions from now on, for every parser of the process
+    module = module or load()
+    for name, function in module.RULES.items():
+        rule = resolve_rule(name)
+        if rule is None:
+            continue
+        _installed.setdefault(rule, rule.__dict__.get('match'))
+        rule.match = classmethod(function)
+
+
+def uninstall():
+    for rule, match in _installed.items():
+        if match is None:
+            del rule.match
+        else:
+            rule.match = match
+    _installed.clear()
+
+
+def _parse(source, repeat=3):
+    # Best parse time of repeat runs, the tree and the output of the last one
+    seconds = float('inf')
+    for _ in range(repeat):
+        obfuscator = CppCodeObfuscator(source, seed=0)
+        start = time.perf_counter()
+        obfuscator.parse()
+        seconds = min(seconds, time.perf_counter() - start)
+    try:
+        tree = encode_tree(source, obfuscator.spans, grammar_version())
+    except (TypeError, RecursionError):
+        tree = None
+    return seconds, tree, ''.join(obfuscator.emit())
+
+
+def check(sources):
+    # Differential test: every source is parsed by the interpreted and by the compiled grammar, trees and output have
+    # to be the same. Returns the number of sources that differ
+    module = load()
+    failures = 0
+    print(f'{"source":32} {"interpreted":>12} {"compiled":>12} {"speedup":>8}')
+    for name, source in sources:
+        uninstall()
+        interpreted = _parse(source)
+        install(module)
+        compiled = _parse(source)
+        uninstall()
+        same = interpreted[1:] == compiled[1:]
+        failures += not same
+        print(f'{name[-32:]:32} {interpreted[0]:12.4f} {compiled[0]:12.4f} {interpreted[0] / compiled[0]:8.2f}'
+              f'{"" if same else "  DIFFERENT"}')
+    return failures
+
+
+def _sources(paths, sizes, shapes):
+    for shape in shapes:
+        for size in sizes:
+            yield f'{shape}_{size}k', generate_source(size * 1024, shape)
+    from batch import collect_sources
+    for filename, _ in collect_sources(paths):
+        with open(filename, 'r') as f:
+            yield filename, f.read()
+
+
+parser = argparse.ArgumentParser(description='Compile the grammar into python functions')
+parser.add_argument('paths', nargs='*', metavar='filename', help='Sources of the differential check')
+parser.add_argument('-o', metavar='filename', default=None,
+                    help='Write the compiled module to a file instead of the cache directory')
+parser.add_argument('--directory', default=DEFAULT_DIRECTORY, help='Cache directory of compiled grammars')
+parser.add_argument('--check', action='store_true',
+                    help='Compare trees and output of the interpreted and the compiled grammar on the benchmark '
+                         'corpus and the given sources, exit code 1 if they differ')
+parser.add_argument('--sizes', metavar='KB', type=int, nargs='*', default=[16, 64], help='Sizes of generated sources')
+parser.add_argument('--shapes', nargs='*', choices=SHAPES, default=list(SHAPES), help='Shapes of generated sources')
+
+
+def main(args):
+    if args.o:
+        source, skipped = compile_grammar()
+        with open(args.o, 'w') as f:
+            f.write(source)
+        print(f'{args.o}: interpreted rules: {", ".join(skipped) or "none"}')
+    if args.check:
+        failures = check(_sources(args.paths, args.sizes, args.shapes))
+        print(f'{failures} sources differ' if failures else 'compiled grammar matches the interpreter')
+        sys.exit(1 if failures else 0)
+    if not args.o:
+        module = load(args.directory)
+        print(f'{module.__file__ if hasattr(module, "__file__") else "in memory"}: {len(module.RULES)} rules')
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
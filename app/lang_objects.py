@@ -1,64 +1,88 @@
-from random import shuffle
+import re
 
 from parser_utils import *
-from config import obfuscator_settings, key_words
+from lexer import WORD, STRING
+from config import DEFAULT_SETTINGS
 from constants import *
 from utils import str_indent
 
 
-class CSpaces(CodePart):
+# Deprecated: whitespace is trivia between tokens, not a token. Matches the whitespace and comments before the current
+# token without taking a token, so custom rules fitting spaces still parse
+class CSpaces(TextPart):
+    __slots__ = ()
+
     def __init__(self, it):
-        self.value = fit_regex(it, r'\s+')
+        tokens = it.tokens
+        index = it.index
+        self.set_span(it.text, tokens.ends[index - 1] if index else 0, tokens.starts[index])
 
 
-class CSymbol(CodePart):
-    def __init__(self, it):
-        self.value = fit(it, r'.|\n')
+# Any one token
+class CSymbol(RegexPart):
+    __slots__ = ()
+    regex = r'(?s).+'
 
 
-class CSemicolon(CodePart):
+class CSemicolon(RegexPart):
+    __slots__ = ()
+    first = ';'
+    regex = ';'
 
-    def __init__(self, it):
-        self.value = fit_regex(it, ';')
 
+class CComma(RegexPart):
+    __slots__ = ()
+    first = ','
+    regex = ','
 
-class CComma(CodePart):
 
-    def __init__(self, it):
-        self.value = fit_regex(it, ',')
+class CWord(RegexPart):
+    __slots__ = ()
+    first = WORD_START
+    token_kind = WORD
 
 
-class CWord(CodePart):
-    def __init__(self, it):
-        self.value = fit_regex(it, r'[a-zA-Z_]\w*')
+class CString(RegexPart):
+    __slots__ = ()
+    first = '"'
+    token_kind = STRING
+
+
+# Source text no rule recognized, passed through as it is
+class CRawText(TextPart):
+    __slots__ = ()
 
 
 class CInclude(CodePart):
+    __slots__ = ('name', 'det1', 'value', 'det2')
+    first = '#'
+
     def __init__(self, it):
         fit(it, specific_symbol('#'))
-        self.name = fit(it, specific_word('include'), allow_spaces=False)
-        suppress_spaces(it)
-        self.det1 = ''
-        with try_fit(it) as f:
-            self.det1 = f(specific_symbol('<'))
-        if not self.det1:
-            self.det1 = fit(it, specific_symbol('"'))
-        suppress_spaces(it)
-        self.value = fit(it, CWord)
-        self.det2 = fit(it, CSymbol)
+        self.name = fit(it, specific_word('include'))
+        self.det1 = try_parse(it, specific_symbol('<'))
+        if self.det1 is None:
+            # "header" is one string token
+            self.det1 = self.det2 = CEmpty(it)
+            self.value = fit(it, CString)
+        else:
+            self.value = fit(it, CWord)
+            self.det2 = fit(it, CSymbol)
 
     def refactor(self, **kwargs):
         return f'#{self.name.refactor(**kwargs)} {self.det1.refactor(**kwargs)}' + \
                f'{self.value.refactor(**kwargs)}{self.det2.refactor(**kwargs)}'
 
 
-class CColon2(CodePart):
-
-    def __init__(self, it):
-        self.value = fit_regex(it, '::')
+class CColon2(RegexPart):
+    __slots__ = ()
+    first = ':'
+    regex = '::'
 
 
 class CWordsList(CodePart):
+    __slots__ = ('items',)
+    first = WORD_START
 
     def __init__(self, it):
         self.items = fit(it, [CWord], sep=CComma)
@@ -68,6 +92,9 @@ class CWordsList(CodePart):
 
 
 class CTypeFull(CodePart):
+    __slots__ = ('const', 'type', 'link', 'pointer')
+    first = WORD_START
+
     def __init__(self, it):
         self.const = have_item(it, specific_word('const'))
         self.type = fit(it, CType)
@@ -85,6 +112,9 @@ class CTypeFull(CodePart):
 
 
 class CType(CodePart):
+    __slots__ = ('args', 'namespace', 'name')
+    first = WORD_START
+
     def __init__(self, it):
         self.args = None
         with try_fit(it) as f:
@@ -102,7 +132,8 @@ class CType(CodePart):
         if f.fail:
             self.name = fit(it, CWord)
 
-        if self.name.value in key_words:
+        settings = it.context.settings or DEFAULT_SETTINGS
+        if self.name.value in settings.key_words:
             raise NotFitException
 
     def refactor(self, **kwargs):
@@ -116,6 +147,9 @@ class CType(CodePart):
 
 
 class CFuncArgument(CodePart):
+    __slots__ = ('type', 'name')
+    first = WORD_START
+
     def __init__(self, it):
         self.type = fit(it, CTypeFull)
         self.name = fit(it, CWord)
@@ -128,6 +162,9 @@ class CFuncArgument(CodePart):
 
 
 class CFuncArguments(CodePart):
+    __slots__ = ('args',)
+    first = '('
+
     def __init__(self, it):
         fit(it, specific_symbol('('))
         self.args = []
@@ -140,19 +177,14 @@ class CFuncArguments(CodePart):
 
 
 class CFuncFullName(CodePart):
+    __slots__ = ('virtual', 'friend', 'name', 'const')
+    first = WORD_START | {'~'}
+
     def __init__(self, it):
         self.virtual = have_item(it, specific_word('virtual'))
         self.friend = have_item(it, specific_word('friend'))
 
-        self.name = None
-        with try_fit(it) as f:
-            self.name = f(CMethodDestructor)
-        if not self.name:
-            with try_fit(it) as f: self.name = f(CMethodConstructor)
-        if not self.name:
-            with try_fit(it) as f: self.name = f(CFuncName)
-        if not self.name:
-            raise NotFitException
+        self.name = fit_choice(it, CMethodDestructor, CMethodConstructor, CFuncName)
 
         self.const = have_item(it, specific_word('const'))
 
@@ -168,23 +200,33 @@ class CFuncFullName(CodePart):
         return res
 
 
+# Operator symbols up to the argument list of an operator function
+OPERATOR_SYMBOLS = re.compile(r'[^(]+')
+
+
 class CFuncNameString(CodePart):
+    __slots__ = ('operation', 'word')
+    first = WORD_START
+
     def __init__(self, it):
         self.operation = None
         self.word = None
         with try_fit(it) as f:
             f(specific_word('operator'))
-            self.operation = f(r'[^(]+')
+            self.operation = f(OPERATOR_SYMBOLS)
         if not f.success:
             self.word = fit(it, CWord)
 
     def refactor(self, **kwargs):
         if self.word:
             return self.word.refactor(**kwargs)
-        return f'operator {self.operation}'
+        return 'operator ' + merge(self.operation, **kwargs)
 
 
 class CFuncName(CodePart):
+    __slots__ = ('c_type', 'c_class', 'c_name', 'c_args')
+    first = WORD_START
+
     def __init__(self, it):
         self.c_type = fit(it, CTypeFull)
         with try_fit(it) as f:
@@ -205,6 +247,9 @@ class CFuncName(CodePart):
 
 
 class CFuncDeclaration(CodePart):
+    __slots__ = ('func', 'equal_zero', 'default')
+    first = WORD_START | {'~'}
+
     def __init__(self, it):
         self.func = fit(it, CFuncFullName)
         self.equal_zero = False
@@ -230,67 +275,124 @@ class CFuncDeclaration(CodePart):
         return res
 
 
+# Comments before the current token, kept in the output ahead of it. A line break after them is kept, a line comment
+# must not swallow the token
+def comments_before(it):
+    text = it.tokens.comments(it.index)
+    comments = text.rstrip()
+    if not comments:
+        return ''
+    return comments + ('\n' if '\n' in text[len(comments):] else ' ')
+
+
+# Statements nest through CBody, CCommand, CConstructionIfElse, CConstructionFor and CBodyOrInstruction. They are
+# written as steps, so match_steps parses any depth of nesting without python recursion
 class CBody(CodePart):
-    def __init__(self, it):
+    __slots__ = ('expressions', 'comments', 'end_comments')
+    first = '{'
+
+    @classmethod
+    def steps(cls, it):
+        comments = comments_before(it)
         fit(it, specific_symbol('{'))
-        self.expressions = []
-        with try_fit(it) as f:
-            self.expressions = f([CCommand])
+        # A brace without a pair can not end the body
+        if it.tokens.pairs[it.index - 1] < 0:
+            raise NotFitException
+        node = cls.__new__(cls)
+        node.comments = comments
+        node.expressions = []
+        while True:
+            command = yield CCommand
+            if command is None:
+                break
+            node.expressions.append(command)
+        node.end_comments = comments_before(it).rstrip()
         fit(it, specific_symbol('}'))
+        return node
 
-    def refactor(self, indent=0, **kwargs):
-        return '{\n' + \
-               refactor_list(self.expressions, join='\n',
-                             indent=indent + obfuscator_settings[INDENT], **kwargs) + '\n' + \
-               str_indent(indent) + '}'
+    def refactor(self, **kwargs):
+        return ''.join(fragments(self, **kwargs))
+
+    def emit(self, indent=0, settings=DEFAULT_SETTINGS, **kwargs):
+        yield self.comments + '{\n'
+        yield from emit_list(self.expressions, join='\n', indent=indent + settings.indent, settings=settings, **kwargs)
+        if self.end_comments:
+            yield '\n' + str_indent(indent + settings.indent) + self.end_comments
+        yield '\n' + str_indent(indent) + '}'
 
 
 class CBodyOrInstruction(CodePart):
-    def __init__(self, it):
-        self.body = None
-        with try_fit(it) as f:
-            self.body = f(CBody)
+    __slots__ = ('body', 'exp')
+
+    @classmethod
+    def steps(cls, it):
+        node = cls.__new__(cls)
+        node.body = yield CBody
+        node.exp = None
+        if node.body is None:
+            node.exp = yield CCommand
+            if node.exp is None:
+                raise NotFitException
+        return node
 
-        self.exp = None
-        if f.fail:
-            self.exp = fit(it, CCommand)
+    def refactor(self, **kwargs):
+        return ''.join(fragments(self, **kwargs))
 
-    def refactor(self, indent=0, **kwargs):
+    def emit(self, indent=0, settings=DEFAULT_SETTINGS, **kwargs):
         if self.body:
-            return self.body.refactor(**kwargs, indent=indent)
+            return self.body.emit(**kwargs, indent=indent, settings=settings)
 
-        return self.exp.refactor(indent=indent + obfuscator_settings[INDENT], **kwargs)
+        return self.exp.emit(indent=indent + settings.indent, settings=settings, **kwargs)
 
 
 class CConstructionIfElse(CodePart):
-    def __init__(self, it):
+    __slots__ = ('exp', 'body', 'else_comments', 'else_body')
+    first = 'i'
+
+    @classmethod
+    def steps(cls, it):
         fit(it, specific_word('if'))
-        self.exp = fit(it, CExpressionInBrackets)
-        self.body = fit(it, CBodyOrInstruction)
-        self.else_body = None
-        with try_fit(it) as f:
-            f(specific_word('else'))
-            self.else_body = f(CBodyOrInstruction)
+        node = cls.__new__(cls)
+        node.exp = fit(it, CExpressionInBrackets)
+        node.body = yield CBodyOrInstruction
+        if node.body is None:
+            raise NotFitException
+        node.else_body = None
+        start = it.index
+        node.else_comments = comments_before(it)
+        if have_item(it, specific_word('else')):
+            node.else_body = yield CBodyOrInstruction
+            if node.else_body is None:
+                it.index = start
+        return node
 
     def refactor(self, **kwargs):
-        res = f'if {self.exp.refactor(**kwargs)} {self.body.refactor(**kwargs)}'
+        return ''.join(fragments(self, **kwargs))
+
+    def emit(self, **kwargs):
+        yield f'if {self.exp.refactor(**kwargs)} '
+        yield from self.body.emit(**kwargs)
         if self.else_body:
-            res += f' else {self.else_body.refactor(**kwargs)}'
-        return res
+            yield ' ' + self.else_comments + 'else '
+            yield from self.else_body.emit(**kwargs)
 
 
-class CExpressionUntilBracket(CodePart):
-    def __init__(self, it):
-        s = fit_regex(it, r'[^)]+')
-        while s.count('(') != s.count(')'):
-            s += ')'
-            it.shift(1)
-            s += fit_regex(it, r'[^)]*')
+class CExpressionUntilBracket(TextPart):
+    __slots__ = ()
 
-        self.value = s
+    def __init__(self, it):
+        tokens = it.tokens
+        end = tokens.expression_end(it.index)
+        if end is None or end == it.index:
+            raise NotFitException
+        self.set_span(it.text, tokens.leads[it.index], tokens.starts[end])
+        it.index = end
 
 
 class CExpressionInBrackets(CodePart):
+    __slots__ = ('exp',)
+    first = '('
+
     def __init__(self, it):
         fit(it, specific_symbol('('))
         self.exp = CEmpty(it)
@@ -303,43 +405,97 @@ class CExpressionInBrackets(CodePart):
         return f'( {self.exp.refactor(**kwargs)} )'
 
 
-class CFullExpression(CodePart):
+class CFullExpression(TextPart):
+    __slots__ = ()
+
     def __init__(self, it):
-        with try_fit(it) as f:
-            f(specific_symbol('}'))
-        if f.success:
+        if have_item(it, specific_symbol('}')):
             raise NotFitException
 
-        self.value = fit(it, r'[^;]*;')
+        tokens = it.tokens
+        end = tokens.firsts.find(';', it.index)
+        if end < 0:
+            raise NotFitException
+        self.set_span(it.text, tokens.leads[it.index], tokens.ends[end])
+        it.index = end + 1
 
 
-class CCommand(CodePart):
-    def __init__(self, it):
+class CConstructionFor(CodePart):
+    __slots__ = ('e1', 'e2', 'e3', 'body')
+    first = 'f'
+
+    @classmethod
+    def steps(cls, it):
+        fit(it, specific_word('for'))
+        fit(it, specific_symbol('('))
+        node = cls.__new__(cls)
+        node.e1 = fit(it, CFullExpression)
+        node.e2 = fit(it, CFullExpression)
+        node.e3 = CEmpty(it)
         with try_fit(it) as f:
-            self.value = f(CConstructionIfElse)
-        if f.fail:
-            with try_fit(it) as f:
-                self.value = f(CConstructionFor)
-        if f.fail:
-            with try_fit(it) as f:
-                self.value = f(CFullExpression)
-        if f.fail:
+            node.e3 = f(CExpressionUntilBracket)
+
+        fit(it, specific_symbol(')'))
+        node.body = yield CBodyOrInstruction
+        if node.body is None:
             raise NotFitException
+        return node
+
+    def refactor(self, **kwargs):
+        return ''.join(fragments(self, **kwargs))
+
+    def emit(self, **kwargs):
+        yield f'for ({self.e1.refactor(**kwargs)} {self.e2.refactor(**kwargs)} {self.e3.refactor(**kwargs)}) '
+        yield from self.body.emit(**kwargs)
+
+
+class CCommand(ChoicePart):
+    __slots__ = ('comments',)
+    choices = (CConstructionIfElse, CConstructionFor, CFullExpression)
+
+    @classmethod
+    def steps(cls, it):
+        comments = comments_before(it).rstrip()
+        for choice in cls.dispatcher.candidates(it.lookahead()):
+            value = yield choice
+            if value is not None:
+                node = cls.__new__(cls)
+                node.value = value
+                # The span of an expression starts at its comments
+                node.comments = '' if isinstance(value, TextPart) else comments
+                return node
+        return None
 
-    def refactor(self, indent=0, **kwargs):
-        return str_indent(indent) + self.value.refactor()
+    def refactor(self, **kwargs):
+        return ''.join(fragments(self, **kwargs))
+
+    def emit(self, indent=0, **kwargs):
+        if self.comments:
+            yield str_indent(indent) + self.comments + '\n'
+        yield str_indent(indent)
+        # Run by fragments(), statements nested in the command do not add to the generator chain
+        yield self.value.emit(**kwargs)
+
+
+CCommand.dispatcher = Dispatcher(CCommand.choices)
 
 
 class CFuncDeclarationAssignment(CodePart):
+    __slots__ = ('name', 'exp')
+    first = WORD_START
+
     def __init__(self, it):
         self.name = fit(it, CWord)
         self.exp = fit(it, CExpressionInBrackets)
 
     def refactor(self, **kwargs):
-        return f'{self.name}{self.exp}'
+        return self.name.refactor(**kwargs) + self.exp.refactor(**kwargs)
 
 
 class CFuncImplementation(CodePart):
+    __slots__ = ('name', 'assignments', 'body')
+    first = WORD_START | {'~'}
+
     def __init__(self, it):
         self.name = fit(it, CFuncFullName)
         self.assignments = []
@@ -349,24 +505,36 @@ class CFuncImplementation(CodePart):
         self.body = fit(it, CBody)
 
     def refactor(self, **kwargs):
-        res = self.name.refactor(**kwargs)
+        return ''.join(fragments(self, **kwargs))
+
+    def emit(self, **kwargs):
+        yield self.name.refactor(**kwargs)
         if self.assignments:
-            res += ': ' + refactor_list(self.assignments, join=', ')
-        res += ' ' + self.body.refactor(**kwargs)
-        return res
+            yield ': ' + refactor_list(self.assignments, join=', ')
+        yield ' '
+        yield from self.body.emit(**kwargs)
 
 
 class CMethodDestructor(CodePart):
+    __slots__ = ('value',)
+    first = '~'
+
     def __init__(self, it):
         self.value = fit(it, specific_symbol('~')), fit(it, CMethodConstructor)
 
 
 class CEmpty(CodePart):
+    __slots__ = ()
+    value = ''
+
     def __init__(self, it):
-        self.value = ''
+        pass
 
 
 class CMethodConstructor(CodePart):
+    __slots__ = ('name', 'args')
+    first = WORD_START
+
     def __init__(self, it):
         self.name = fit(it, CWord)
         self.args = fit(it, CFuncArguments)
@@ -375,51 +543,47 @@ class CMethodConstructor(CodePart):
         return f'{self.name.refactor(**kwargs)} {self.args.refactor(**kwargs)}'
 
 
-class CConstructionFor(CodePart):
-    def __init__(self, it):
-        fit(it, specific_word('for'))
-        fit(it, specific_symbol('('))
-        self.e1 = fit(it, CFullExpression)
-        self.e2 = fit(it, CFullExpression)
-        self.e3 = CEmpty(it)
-        with try_fit(it) as f:
-            self.e3 = f(CExpressionUntilBracket)
-
-        fit(it, specific_symbol(')'))
-        self.body = fit(it, CBodyOrInstruction)
-
-    def refactor(self, **kwargs):
-        return f'for ({self.e1.refactor()} {self.e2.refactor()} {self.e3.refactor()}) {self.body.refactor(**kwargs)}'
-
-
-class CFunction(CodePart):
-    def __init__(self, it):
-        self.value = fit_choice(it, CFuncDeclaration, CFuncImplementation)
+class CFunction(ChoicePart):
+    __slots__ = ()
+    choices = (CFuncDeclaration, CFuncImplementation)
 
 
 class CVariableInit(CodePart):
+    __slots__ = ('type', 'name')
+    first = WORD_START
+
     def __init__(self, it):
         self.type = fit(it, CTypeFull)
         self.name = fit(it, CFullExpression)
 
     def refactor(self, **kwargs):
-        return f'{self.type} {self.name}'
+        return f'{self.type.refactor(**kwargs)} {self.name.refactor(**kwargs)}'
 
 
-class CFuncOrVarInit(CodePart):
-    def __init__(self, it):
-        self.value = fit_choice(it, CFunction, CVariableInit)
+class CFuncOrVarInit(ChoicePart):
+    __slots__ = ()
+    choices = (CFunction, CVariableInit)
 
-    def refactor(self, indent=0, **kwargs):
-        return str_indent(indent) + self.value.refactor(**kwargs, indent=indent)
+    def refactor(self, **kwargs):
+        return ''.join(fragments(self, **kwargs))
+
+    def emit(self, indent=0, **kwargs):
+        yield str_indent(indent)
+        yield from self.value.emit(**kwargs, indent=indent)
 
 
 class CClassAttributes(CodePart):
+    __slots__ = ('value',)
+    first = WORD_START | {'~'}
+
     def __init__(self, it):
         self.value = fit(it, [CFuncOrVarInit])
 
 
 class CClass(CodePart):
+    __slots__ = ('name', 'private_sections', 'public_sections', 'sections')
+    first = 'c'
+
     def __init__(self, it):
         fit(it, specific_word('class'))
         self.name = fit(it, CWord)
@@ -438,6 +602,13 @@ class CClass(CodePart):
         fit(it, CSemicolon)
 
     def refactor(self, **kwargs):
+        return ''.join(fragments(self, **kwargs))
+
+    def emit(self, settings=DEFAULT_SETTINGS, rng=None, **kwargs):
+        # rng is the random.Random of the obfuscation. The members are never shuffled by an unseeded one, output of a
+        # seed would depend on the path that rendered the class
+        if rng is None:
+            raise TypeError('CClass.emit() needs the rng of the obfuscation')
         private_sections = self.private_sections + list(
             filter(lambda x: x.value.section_type == 'private', self.sections))
         public_sections = self.public_sections + list(
@@ -445,24 +616,32 @@ class CClass(CodePart):
 
         public_attrs = sum(map(lambda x: x.value.attrs.value, public_sections), [])
         private_attrs = sum(map(lambda x: x.value.attrs.value, private_sections), [])
-        shuffle(public_attrs)
-        shuffle(private_attrs)
-        res = f'class {self.name}' + ' {\n'
-        res += 'private:\n' + refactor_list(private_attrs, join='\n', indent=obfuscator_settings[INDENT])
-        res += '\n\npublic:\n' + refactor_list(public_attrs, join='\n\n', indent=obfuscator_settings[INDENT])
-        res += '\n};'
-        return res
+        rng.shuffle(public_attrs)
+        rng.shuffle(private_attrs)
+        yield f'class {self.name.refactor(**kwargs)}' + ' {\n'
+        yield 'private:\n'
+        yield from emit_list(private_attrs, join='\n', indent=settings.indent, settings=settings, rng=rng, **kwargs)
+        yield '\n\npublic:\n'
+        yield from emit_list(public_attrs, join='\n\n', indent=settings.indent, settings=settings, rng=rng, **kwargs)
+        yield '\n};'
 
 
 class CClassSection(CodePart):
+    __slots__ = ('value',)
+    first = 'p'
+    sections = {}
 
-    @staticmethod
-    def generate_class_section(section_type):
+    @classmethod
+    def generate_class_section(cls, section_type):
         assert section_type == 'public' or section_type == 'private'
+        if section_type in cls.sections:
+            return cls.sections[section_type]
 
         class CClassParticularSection(CodePart):
+            __slots__ = ('attrs',)
+            first = section_type[0]
+
             def __init__(self, it):
-                self.section_type = section_type
                 fit(it, specific_word(section_type))
                 fit(it, specific_symbol(':'))
                 self.attrs = CEmpty(it)
@@ -472,27 +651,58 @@ class CClassSection(CodePart):
             def refactor(self, **kwargs):
                 return f'{section_type}:\n{self.attrs.refactor(**kwargs)}'
 
-        return CClassParticularSection
+        CClassParticularSection.section_type = section_type
+        CClassParticularSection.rule_name = f'CClassParticularSection({section_type!r})'
+        return cls.sections.setdefault(section_type, CClassParticularSection)
 
     def __init__(self, it):
         self.value = fit_choice(it, self.generate_class_section('public'), self.generate_class_section('private'))
 
 
-def specific_symbol(symbol):
-    class SpecificSymbol(CSymbol):
-        def __init__(self, it):
-            super().__init__(it)
-            if self.value != symbol:
-                raise NotFitException
+# Rules are interned: one class per symbol or word, so they are created once and have a stable identity for memo keys.
+# Their value is a class attribute and every match returns the same node. Of two threads creating the same rule the
+# first stored wins, setdefault is atomic
+_specific_symbols = {}
+_specific_words = {}
+
 
-    return SpecificSymbol
+def specific_symbol(symbol):
+    rule = _specific_symbols.get(symbol)
+    if rule is None:
+        class SpecificSymbol(CSymbol):
+            __slots__ = ()
+            first = symbol[0]
+            value = symbol
+
+            @classmethod
+            def match(cls, it):
+                if match_token_text(it, symbol):
+                    return cls.node
+                return None
+
+        SpecificSymbol.node = SpecificSymbol.__new__(SpecificSymbol)
+        SpecificSymbol.symbol = symbol
+        SpecificSymbol.rule_name = f'SpecificSymbol({symbol!r})'
+        rule = _specific_symbols.setdefault(symbol, SpecificSymbol)
+    return rule
 
 
 def specific_word(word):
-    class SpecificWord(CWord):
-        def __init__(self, it):
-            super().__init__(it)
-            if self.value != word:
-                raise NotFitException
-
-    return SpecificWord
+    rule = _specific_words.get(word)
+    if rule is None:
+        class SpecificWord(CWord):
+            __slots__ = ()
+            first = word[0]
+            value = word
+
+            @classmethod
+            def match(cls, it):
+                if match_token_text(it, word):
+                    return cls.node
+                return None
+
+        SpecificWord.node = SpecificWord.__new__(SpecificWord)
+        SpecificWord.word = word
+        SpecificWord.rule_name = f'SpecificWord({word!r})'
+        rule = _specific_words.setdefault(word, SpecificWord)
+    return rule
@@ -0,0 +1,241 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, compress
+from operator import itemgetter
+
+# Token kinds
+WORD = 1
+NUMBER = 2
+STRING = 3
+CHAR = 4
+PUNCT = 5
+END = 6
+
+# Splitting by pieces leaves whitespace between them. A piece is a token or a comment, punctuation is one character
+# per token except '::', the grammar pairs '<' and '>' itself
+_PIECES = re.compile(
+    r'([a-zA-Z_]\w*'
+    r'|\d[\w.\']*'
+    r'|"(?:\\.|[^"\\\n])*"'
+    r'|\'(?:\\.|[^\'\\\n])*\''
+    r'|//[^\n]*|/\*(?s:.*?)(?:\*/|\Z)'
+    r'|::'
+    r'|\S)'
+)
+
+
+def _kind_of_first(char):
+    if char == '_' or 'a' <= char.lower() <= 'z':
+        return WORD
+    if '0' <= char <= '9':
+        return NUMBER
+    return {'"': STRING, "'": CHAR}.get(char, PUNCT)
+
+
+# Kind of a token is told by its first character. A lone quote is punctuation, it is fixed up afterwards
+_KIND_BY_FIRST = {i: _kind_of_first(chr(i)) for i in range(128)}
+_NON_ASCII = re.compile(r'[^\x00-\x7f]')
+_QUOTE = re.compile(r'["\']')
+_SLASH = re.compile(r'/')
+_BRACKET = re.compile(r'[()\[\]{}]')
+_PARENTHESES = re.compile(r'[()]')
+_STATEMENT_END = re.compile(r'[;#(\[{]')
+_OPENING = {')': '(', ']': '[', '}': '{'}
+# First character of the end token
+END_CHAR = '\0'
+
+
+def _array(typecode, items):
+    res = array(typecode)
+    res.fromlist(items)
+    return res
+
+
+# C++ token stream built in one pass over the source: token kinds and offsets in array buffers. Whitespace and
+# comments are trivia, kept on the side as the gaps between tokens, so the source is reconstructed from the stream.
+# The per token work is done by re, str.translate and itertools, only comments and brackets are looked at one by one
+class TokenStream:
+    def __init__(self, text):
+        self.text = text
+        # Whitespace, piece, whitespace, ..., piece, whitespace
+        parts = _PIECES.split(text)
+        offsets = list(accumulate(map(len, parts), initial=0))
+        # The end token starts at len(text) and ends there
+        starts = offsets[1::2]
+        ends = offsets[2::2]
+        ends.append(len(text))
+        pieces = parts[1::2]
+        firsts = ''.join(map(itemgetter(0), pieces)) + END_CHAR
+
+        # Start of the comments before the token, or of the token itself without comments
+        leads = None
+        comments = [i for i in (m.start() for m in _SLASH.finditer(firsts)) if ends[i] - starts[i] > 1]
+        opaque = [(starts[i], ends[i]) for i in comments]
+        if comments:
+            leads = list(starts)
+            lead = None
+            in_comments = set(comments)
+            for i in comments:
+                if lead is None:
+                    lead = starts[i]
+                if i + 1 not in in_comments:
+                    leads[i + 1] = lead
+                    lead = None
+            is_token = bytearray(b'\1') * len(starts)
+            for i in comments:
+                is_token[i] = 0
+            starts = list(compress(starts, is_token))
+            ends = list(compress(ends, is_token))
+            leads = list(compress(leads, is_token))
+            firsts = ''.join(compress(firsts, is_token))
+
+        self.starts = _array('i', starts)
+        self.ends = _array('i', ends)
+        self.leads = _array('i', leads) if leads is not None else self.starts
+        # First character of every token, the end token included. Lookahead for dispatching and fast searches
+        # for punctuation, which is never a part of longer tokens
+        self.firsts = firsts
+
+        kinds = bytearray(_NON_ASCII.sub(chr(PUNCT), firsts.translate(_KIND_BY_FIRST)), 'ascii')
+        for match in _QUOTE.finditer(firsts):
+            index = match.start()
+            if self.ends[index] - self.starts[index] == 1:
+                kinds[index] = PUNCT
+            else:
+                opaque.append((self.starts[index], self.ends[index]))
+        kinds[-1] = END
+        self.kinds = array('B', kinds)
+
+        # Interval index of string and char literals and comments, sorted by start. Their text is not code, regex
+        # matches over the source stop before them. Both lists are sorted, sort() only merges them
+        opaque.sort()
+        self.opaque_starts = _array('i', [start for start, _ in opaque])
+        self.opaque_ends = _array('i', [end for _, end in opaque])
+
+        # Token index of the matching (), [] or {} bracket, -1 for other tokens and brackets without a pair
+        self.pairs = array('i', [-1]) * len(firsts)
+        stack = []
+        for match in _BRACKET.finditer(firsts):
+            index = match.start()
+            char = match.group()
+            if char in '([{':
+                stack.append(index)
+            elif stack and firsts[stack[-1]] == _OPENING[char]:
+                opening = stack.pop()
+                self.pairs[opening] = index
+                self.pairs[index] = opening
+
+    def __len__(self):
+        # Number of tokens without the end token
+        return len(self.kinds) - 1
+
+    def next_token(self, offset):
+        # Index of the first token starting at or after the source offset
+        return bisect_left(self.starts, offset)
+
+    def opaque_after(self, offset):
+        # Start of the first literal or comment starting after offset, the end of the source if there is none
+        index = bisect_right(self.opaque_starts, offset)
+        return self.opaque_starts[index] if index < len(self.opaque_starts) else len(self.text)
+
+    def is_neutral(self, offset):
+        # True if lexing the text from offset on gives the tokens this stream has there: offset is not inside a token,
+        # a comment or a preprocessor line begun before it
+        index = self.next_token(offset)
+        if index and self.ends[index - 1] > offset:
+            return False
+        index = bisect_right(self.opaque_starts, offset) - 1
+        if index >= 0 and self.opaque_ends[index] > offset > self.opaque_starts[index]:
+            return False
+        # Start of the line, lines continued by a backslash are one line
+        text = self.text
+        line = text.rfind('\n', 0, offset)
+        while line > 0 and text[line - 1] == '\\':
+            line = text.rfind('\n', 0, line - 1)
+        line += 1
+        return line == offset or not text[line:offset].lstrip().startswith('#')
+
+    def token_text(self, index):
+        return self.text[self.starts[index]:self.ends[index]]
+
+    def trivia(self, index):
+        # Whitespace and comments before the token
+        return self.text[self.ends[index - 1] if index else 0:self.starts[index]]
+
+    def comments(self, index):
+        # Comments before the token with the whitespace after them, '' when there are none
+        return self.text[self.leads[index]:self.starts[index]]
+
+    def expression_end(self, index):
+        # Index of the first ')' closing a parenthesis opened before index, nested pairs are jumped over at once.
+        # None if there is no such parenthesis
+        firsts = self.firsts
+        pairs = self.pairs
+        while True:
+            match = _PARENTHESES.search(firsts, index)
+            if match is None:
+                return None
+            found = match.start()
+            pair = pairs[found]
+            if pair < 0:
+                index = found + 1
+            elif pair > found:
+                index = pair + 1
+            else:
+                return found
+
+    def statement_end(self, index):
+        # Index after the top level statement starting at index: past the first ';' or {} block outside of brackets,
+        # a ';' right after the block included, or up to the next preprocessor line. Nested pairs are jumped over
+        firsts = self.firsts
+        pairs = self.pairs
+        if firsts[index] == '#':
+            # Preprocessor line, up to a line break not escaped by a backslash
+            index += 1
+            while index < len(self) and ('\n' not in self.trivia(index) or firsts[index - 1] == '\\'):
+                index += 1
+            return index
+        position = index
+        while True:
+            match = _STATEMENT_END.search(firsts, position)
+            if match is None:
+                return len(self)
+            found = match.start()
+            char = match.group()
+            pair = pairs[found]
+            if char == ';':
+                return found + 1
+            if char == '#':
+                if found > index and '\n' in self.trivia(found):
+                    return found
+            elif char == '{' and pair > found:
+                return pair + 2 if firsts[pair + 1] == ';' else pair + 1
+            elif pair > found:
+                position = pair + 1
+                continue
+            position = found + 1
+
+    def reconstruct(self):
+        return ''.join(self.trivia(i) + self.token_text(i) for i in range(len(self.kinds)))
+
+
+# Identifiers, literals, numbers and comments, the rest of the source is punctuation and whitespace
+_WORD_PIECES = re.compile(
+    r'([a-zA-Z_]\w*'
+    r'|\d[\w.\']*'
+    r'|"(?:\\.|[^"\\\n])*"'
+    r'|\'(?:\\.|[^\'\\\n])*\''
+    r'|//[^\n]*|/\*(?s:.*?)(?:\*/|\Z))'
+)
+
+
+def identifiers(text):
+    # Set of the identifiers of a source, words in strings, chars and comments are not counted
+    return {piece for piece in set(_WORD_PIECES.findall(text)) if _KIND_BY_FIRST.get(ord(piece[0])) == WORD}
+
+
+def split_words(text):
+    # Parts of text, the odd ones are identifiers, literals, numbers and comments. Text has to start and end between
+    # tokens
+    return _WORD_PIECES.split(text)
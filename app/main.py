@@ -1,19 +1,184 @@
 #!/bin/python3
 
+import time
+
+_START = time.perf_counter()
+
 import argparse
+import random
+import sys
 
-from code_obfuscator import CppCodeObfuscator
+from batch import is_batch
+from parser_utils import PackratCache
+from profiler import RuleProfiler, StartupProfile
+from refactor_cache import RefactorCache
 
 parser = argparse.ArgumentParser(description='Obfuscate c++ code')
-parser.add_argument('filename', help='Input *.cpp filename')
-parser.add_argument('-o', metavar='output', default='a.cpp',
-                    help='Output code filename. Default a.cpp', required=False)
+parser.add_argument('paths', nargs='+', metavar='filename',
+                    help='Input *.cpp filename. Several files, directories or glob patterns run a batch')
+parser.add_argument('-o', metavar='output', default=None,
+                    help='Output code filename. Default a.cpp. In batch mode output directory, default obfuscated',
+                    required=False)
+parser.add_argument('-j', metavar='jobs', type=int, default=None,
+                    help='Worker processes in batch mode and for variants. Default cpu count', required=False)
+parser.add_argument('--memo-size', metavar='entries', type=int, default=PackratCache.DEFAULT_MAX_ENTRIES,
+                    help='Max packrat memo entries, 0 disables memoization', required=False)
+parser.add_argument('--seed', metavar='seed', default=None,
+                    help='Seed for reproducible output', required=False)
+parser.add_argument('--variants', metavar='N', type=int, default=None,
+                    help='Write N variants output.0.cpp ... from one parse, variant i is the output with seed "seed:i". '
+                         'Single file mode, -j worker processes', required=False)
+parser.add_argument('--split', metavar='KB', type=int, default=None,
+                    help='Split one big file into chunks of about KB kilobytes at top level statements, parsed and '
+                         'refactored in -j worker processes. With --seed the output is the same as without it',
+                    required=False)
+parser.add_argument('--cache', metavar='directory', default=None,
+                    help='Directory of the incremental cache of refactored elements', required=False)
+parser.add_argument('--cache-size', metavar='MB', type=int, default=RefactorCache.DEFAULT_MAX_BYTES // 2 ** 20,
+                    help='Max size of cached output in megabytes', required=False)
+parser.add_argument('--tree-cache', metavar='directory', default=None,
+                    help='Directory of parse trees, sources parsed before are loaded instead of parsed', required=False)
+parser.add_argument('--max-steps', metavar='steps', type=int, default=None,
+                    help='Parse steps allowed for one top level element, an element over it is passed through '
+                         'unchanged', required=False)
+parser.add_argument('--max-seconds', metavar='seconds', type=float, default=None,
+                    help='Parse time allowed for one top level element, same as --max-steps', required=False)
+parser.add_argument('--rename', action='store_true',
+                    help='Rename identifiers declared by classes, functions, arguments and variables consistently over '
+                         'all input files', required=False)
+parser.add_argument('-I', metavar='directory', action='append', default=[], dest='include_dirs',
+                    help='Include directory for --rename, identifiers of headers found outside of the input files are '
+                         'not renamed', required=False)
+parser.add_argument('--symbols', metavar='filename', default=None,
+                    help='Keep the symbol index of --rename in this file', required=False)
+parser.add_argument('--compiled-grammar', action='store_true',
+                    help='Parse with the grammar compiled into python functions by grammar_compiler.py', required=False)
+parser.add_argument('--profile', action='store_true',
+                    help='Print per rule parse statistics, single file mode', required=False)
+parser.add_argument('--profile-json', metavar='filename', default=None,
+                    help='Save per rule parse statistics as json', required=False)
+parser.add_argument('--profile-stacks', metavar='filename', default=None,
+                    help='Save parse time per rule call stack in flame graph collapsed format', required=False)
+parser.add_argument('--startup-profile', action='store_true',
+                    help='Print time of imports, grammar construction and every stage of the run', required=False)
+
+
+def rename(obfuscator, args):
+    # Both phases of renaming over one file share its parse
+    import os
+    import tempfile
+    from symbols import SymbolIndex, build_index, collect
+
+    filename = args.symbols
+    if filename is None:
+        handle, filename = tempfile.mkstemp(suffix='.symbols')
+        os.close(handle)
+    try:
+        build_index(filename, args.paths, [collect(obfuscator, args.paths[0], args.include_dirs)], args.include_dirs,
+                    args.seed, obfuscator.settings.key_words)
+        obfuscator.symbols = SymbolIndex(filename)
+    finally:
+        # The index stays mapped
+        if args.symbols is None:
+            os.remove(filename)
 
 
 def main(args):
-    obfuscator = CppCodeObfuscator.from_file(args.filename)
-    obfuscator.obfuscate()
-    obfuscator.write_file(args.o)
+    # The grammar and the batch machinery are imported only by the mode that needs them
+    startup = StartupProfile(_START)
+    startup.stage('cli imports')
+    if is_batch(args.paths):
+        if args.variants or args.split:
+            parser.error('--variants and --split take one input file')
+        from batch import collect_sources, run_batch
+        try:
+            collect_sources(args.paths)
+        except ValueError as e:
+            parser.error(str(e))
+        report = run_batch(args.paths, args.o or 'obfuscated', jobs=args.j, memo_size=args.memo_size, seed=args.seed,
+                           cache_dir=args.cache, cache_size=args.cache_size * 2 ** 20, tree_cache_dir=args.tree_cache,
+                           max_steps=args.max_steps, max_seconds=args.max_seconds,
+                           compiled_grammar=args.compiled_grammar, rename=args.rename, include_dirs=args.include_dirs,
+                           symbols_file=args.symbols)
+        for src, error in report.failures:
+            print(f'{src}: {error}')
+        for line in report.degraded:
+            print(line)
+        print(report.summary())
+        startup.stage('batch')
+        if args.startup_profile:
+            print(startup.table())
+        # Callers see failed files by the exit status
+        if report.failures:
+            sys.exit(1)
+        return
+
+    if args.split and (args.variants or args.cache or args.tree_cache or args.profile or args.profile_json
+                       or args.profile_stacks):
+        parser.error('--split does not go with --variants, caches and profiles')
+    if args.rename and (args.variants or args.split or args.cache):
+        parser.error('--rename of one file does not go with --variants, --split and --cache')
+    from code_obfuscator import CppCodeObfuscator, write_fragments
+    from tree_cache import TreeCache
+    if args.compiled_grammar:
+        import grammar_compiler
+        grammar_compiler.install()
+    startup.stage('grammar')
+
+    cache = RefactorCache(args.cache, args.cache_size * 2 ** 20) if args.cache else None
+    tree_cache = TreeCache(args.tree_cache) if args.tree_cache else None
+    profiler = RuleProfiler() if args.profile or args.profile_json or args.profile_stacks else None
+    obfuscator = CppCodeObfuscator.from_file(args.paths[0], memo_size=args.memo_size, seed=args.seed, cache=cache,
+                                             profiler=profiler, tree_cache=tree_cache, max_steps=args.max_steps,
+                                             max_seconds=args.max_seconds)
+    startup.stage('read')
+    if args.split:
+        from chunks import obfuscate_chunks
+        with open(args.o or 'a.cpp', 'w') as f:
+            degraded = obfuscate_chunks(obfuscator, f, args.split * 1024, jobs=args.j,
+                                        compiled_grammar=args.compiled_grammar)
+        startup.stage('parse, refactor and write')
+        for line in obfuscator.degraded_report(args.paths[0], degraded):
+            print(line)
+        if args.startup_profile:
+            print(startup.table())
+        return
+    if obfuscator.load_tree():
+        startup.stage('load tree')
+    else:
+        # The token stream is kept by the parse context, parse() reuses it
+        obfuscator.context.token_stream(obfuscator.source_code)
+        startup.stage('lex')
+        obfuscator.parse()
+        startup.stage('parse')
+    if args.rename:
+        rename(obfuscator, args)
+        startup.stage('symbols')
+    if args.variants:
+        from variants import write_variants
+        seed = args.seed if args.seed is not None else str(random.randrange(10 ** 9))
+        for variant_seed, filename in write_variants(obfuscator, args.o or 'a.cpp', seed, args.variants, jobs=args.j):
+            print(f'{filename}: --seed {variant_seed}')
+    else:
+        with open(args.o or 'a.cpp', 'w') as f:
+            write_fragments(f, obfuscator.emit())
+    startup.stage('refactor and write')
+    for line in obfuscator.degraded_report(args.paths[0]):
+        print(line)
+    if args.startup_profile:
+        print(startup.table())
+    if cache:
+        print(cache.stats())
+        cache.close()
+    if tree_cache:
+        print(tree_cache.stats())
+    if profiler:
+        if args.profile:
+            print(profiler.table())
+        if args.profile_json:
+            profiler.write_json(args.profile_json)
+        if args.profile_stacks:
+            profiler.write_collapsed(args.profile_stacks)
 
 
 if __name__ == '__main__':
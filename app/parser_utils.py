@@ -1,26 +1,68 @@
 import re
-from collections import Iterable
-from contextlib import suppress, contextmanager
+import string
+import time
+import warnings
+from collections import OrderedDict
+from collections.abc import Iterable
+from random import Random
 
-from exceptions import NotFitException
+from exceptions import BudgetExceeded, NotFitException
+from lexer import TokenStream
+
+
+WORD_START = frozenset(string.ascii_letters + '_')
 
 
 class CodePart:
+    # Nodes are many and small. Every rule declares __slots__ for its attributes, so no node carries a __dict__
+    __slots__ = ()
+    # Whether packrat memoization applies to the rule, leaves are cheaper to rematch than to look up
+    memoize = True
+    # FIRST set: first characters of the tokens the rule can start with, None if it can start with anything
+    first = None
+    # Generator classmethod for rules run by match_steps, see there
+    steps = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if isinstance(cls.__dict__.get('first'), str):
+            cls.first = frozenset(cls.first)
+        # A rule that defines its own __init__ without a matching fast path goes through the exception shim
+        if '__init__' in cls.__dict__ and 'match' not in cls.__dict__:
+            cls.match = classmethod(CodePart.match.__func__)
+        # A rule written as steps is run by the explicit stack driver
+        if 'steps' in cls.__dict__ and 'match' not in cls.__dict__:
+            cls.match = classmethod(match_steps)
+        # Same for emission: a rule overriding only refactor is emitted as one fragment
+        if 'refactor' in cls.__dict__ and 'emit' not in cls.__dict__:
+            cls.emit = CodePart.emit
+
     @classmethod
     def parse(cls, it):
+        return match_rule(it, cls)
+
+    # Exception free entry point: returns the node, or None leaving it.index untouched.
+    # By default it adapts rules written against the raising __init__(self, it) protocol
+    @classmethod
+    def match(cls, it):
+        start = it.index
         try:
-            it_copy = it.copy()
-            res = cls(it_copy)
-            it.fill_from(it_copy)
-            return res
+            return cls(it)
         except NotFitException:
+            it.index = start
             return None
 
     def refactor(self, **kwargs):
         return merge(self.value, **kwargs)
 
+    # Yields the refactored code in fragments, big containers override it to avoid building nested strings
+    def emit(self, **kwargs):
+        yield self.refactor(**kwargs)
+
+    # A debugging view, members of classes are shuffled by a fixed seed. Output goes through emit with the rng of the
+    # obfuscation
     def __repr__(self):
-        rep = self.refactor().replace('    ', ' ')
+        rep = self.refactor(rng=Random(0)).replace('    ', ' ')
         n = '\n'
         return f'{self.__class__.__name__}({rep.replace(n, " ")[:100]})'
 
@@ -28,29 +70,272 @@ class CodePart:
         return self.refactor()
 
 
+_compiled_patterns = {}
+
+
+def compile_regex(regex):
+    # Patterns are compiled once and looked up by source, re's own cache is too small for the grammar.
+    # Rules should keep their patterns compiled at module level, those are returned as they are
+    if isinstance(regex, re.Pattern):
+        return regex
+    pattern = _compiled_patterns.get(regex)
+    if pattern is None:
+        pattern = _compiled_patterns[regex] = re.compile(regex)
+    return pattern
+
+
+# Node holding a piece of the source as (start, end) offsets, value is sliced only when it is read
+class TextPart(CodePart):
+    __slots__ = ('source', 'start', 'end')
+
+    def set_span(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+
+    @property
+    def value(self):
+        return self.source[self.start:self.end]
+
+    @value.setter
+    def value(self, value):
+        self.set_span(value, 0, len(value))
+
+
+# Leaf rule matching one token, value is the token text. The regex has to match the whole token,
+# with token_kind set only the kind of the token is checked
+class RegexPart(TextPart):
+    __slots__ = ()
+    regex = None
+    pattern = None
+    token_kind = None
+    memoize = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'regex' in cls.__dict__:
+            cls.pattern = compile_regex(cls.regex)
+
+    def __init__(self, it):
+        index = it.index
+        if self.match(it) is None:
+            raise NotFitException
+        self.set_span(it.text, it.tokens.starts[index], it.tokens.ends[index])
+
+    @classmethod
+    def match(cls, it):
+        tokens = it.tokens
+        index = it.index
+        start = tokens.starts[index]
+        end = tokens.ends[index]
+        if cls.token_kind is not None:
+            if tokens.kinds[index] != cls.token_kind:
+                return None
+        elif start == end or cls.pattern.fullmatch(it.text, start, end) is None:
+            return None
+        node = cls.__new__(cls)
+        node.source = it.text
+        node.start = start
+        node.end = end
+        it.index = index + 1
+        return node
+
+
+# Rule taking the first alternative of choices that fits, value is the parsed alternative
+class ChoicePart(CodePart):
+    __slots__ = ('value',)
+    choices = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'choices' in cls.__dict__ and 'first' not in cls.__dict__:
+            cls.first = first_of(cls.choices)
+
+    def __init__(self, it):
+        self.value = fit_choice(it, *self.choices)
+
+    def emit(self, **kwargs):
+        if isinstance(self.value, CodePart):
+            yield from self.value.emit(**kwargs)
+        else:
+            yield self.refactor(**kwargs)
+
+    @classmethod
+    def match(cls, it):
+        value = match_choice(it, *cls.choices)
+        if value is None:
+            return None
+        node = cls.__new__(cls)
+        node.value = value
+        return node
+
+
+def first_of(templates):
+    res = set()
+    for template in templates:
+        first = template.first if type(template) is type and issubclass(template, CodePart) else None
+        if first is None:
+            return None
+        res |= first
+    return frozenset(res)
+
+
+# Picks the templates worth trying at a token from the first character of the token and their FIRST sets.
+# Order of templates is kept, tables are built lazily per lookahead
+class Dispatcher:
+    def __init__(self, templates):
+        self.templates = tuple(templates)
+        self.firsts = [first_of([template]) for template in self.templates]
+        self.tables = {}
+
+    def candidates(self, lookahead):
+        table = self.tables.get(lookahead)
+        if table is None:
+            table = self.tables[lookahead] = tuple(
+                template for template, first in zip(self.templates, self.firsts) if first is None or lookahead in first
+            )
+        return table
+
+
+_dispatchers = {}
+
+
+# Packrat memo table: (rule, start token) -> (node or None on fail, end token)
+# Least recently used entries are evicted when max_entries is reached
+class PackratCache:
+    DEFAULT_MAX_ENTRIES = 200000
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, rule, index):
+        entry = self.table.get((rule, index))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.table.move_to_end((rule, index))
+        return entry
+
+    def put(self, rule, index, node, end):
+        self.table[(rule, index)] = (node, end)
+        if len(self.table) > self.max_entries:
+            self.table.popitem(last=False)
+
+    def clear(self):
+        self.table.clear()
+
+    def __len__(self):
+        return len(self.table)
+
+
+# Limit of the work on one top level element: memoized rule applications (steps) and wall time. start() is called
+# before every element, the clock is read every CLOCK_INTERVAL steps only
+class ParseBudget:
+    CLOCK_INTERVAL = 256
+
+    def __init__(self, max_steps=None, max_seconds=None):
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.steps = 0
+        self.started = 0.0
+        self._next_check = 0
+
+    def start(self):
+        self.steps = 0
+        if self.max_seconds is not None:
+            self.started = time.perf_counter()
+        self._schedule()
+
+    def _schedule(self):
+        next_check = self.steps + self.CLOCK_INTERVAL if self.max_seconds is not None else None
+        if self.max_steps is not None and (next_check is None or self.max_steps < next_check):
+            next_check = self.max_steps
+        self._next_check = next_check if next_check is not None else float('inf')
+
+    def charge(self):
+        self.steps += 1
+        if self.steps > self._next_check:
+            seconds = time.perf_counter() - self.started if self.max_seconds is not None else 0.0
+            if (self.max_steps is not None and self.steps > self.max_steps) or \
+                    (self.max_seconds is not None and seconds > self.max_seconds):
+                raise BudgetExceeded(self.steps, seconds)
+            self._schedule()
+
+
+# State shared by every iterator over one source
+class ParseContext:
+    def __init__(self, memo=None, profiler=None, budget=None, settings=None):
+        # PackratCache or None
+        self.memo = memo
+        # Object with match(it, rule, match_rule) wrapping every rule application and enter, leave and cancel for
+        # the nested rules of match_steps, see RuleProfiler. Or None
+        self.profiler = profiler
+        # TokenStream of the source, built on first use
+        self.tokens = None
+        # Rules written as steps run their nested step rules on one explicit stack. False runs every one of them
+        # through match_rule, with a python call per rule like the other rules
+        self.explicit_stack = True
+        # ParseBudget of every top level element or None
+        self.budget = budget
+        # Settings of the grammar read by rules while parsing, None for the defaults of the grammar
+        self.settings = settings
+        # (start, end, steps) of the top level elements given up over the budget or nested too deep for the python
+        # stack, steps is None for the latter. Their text is passed through as it is
+        self.degraded = []
+
+    def token_stream(self, text):
+        if self.tokens is None or self.tokens.text is not text:
+            self.tokens = TokenStream(text)
+        return self.tokens
+
+
+# Cursor over the token stream of the source. self.index is a token index, backtracking is resetting it
 class StrIterator:
-    def __init__(self, text, index):
+    def __init__(self, text, index=0, context=None, tokens=None):
         self.text = text
         self.index = index
+        self.context = context if context is not None else ParseContext()
+        self.tokens = tokens if tokens is not None else self.context.token_stream(text)
 
     def shift(self, value):
         self.index += value
 
     def copy(self):
-        return StrIterator(self.text, self.index)
+        return StrIterator(self.text, self.index, self.context, self.tokens)
 
     def fill_from(self, other):
         self.index = other.index
 
+    @property
+    def offset(self):
+        # Source offset of the current token
+        return self.tokens.starts[self.index]
+
+    def lookahead(self):
+        # First character of the current token, lexer.END_CHAR at the end
+        return self.tokens.firsts[self.index]
+
+    def match(self, regex):
+        # Regex match over the source from the current token. It stops before the next string or char literal or
+        # comment: their text is not code, a pattern such as [^(]+ must not run into them
+        if self.is_end():
+            return None
+        offset = self.offset
+        return compile_regex(regex).match(self.text, offset, self.tokens.opaque_after(offset))
+
     @property
     def string(self):
-        if self.index >= len(self.text):
-            print('OUT OF RANGE')
+        # Copies the remaining text, kept for custom rules only. Use match() instead
+        if self.is_end():
             raise NotFitException
-        return self.text[self.index:]
+        return self.text[self.offset:]
 
     def is_end(self):
-        return self.index >= len(self.text)
+        return self.index >= len(self.tokens)
 
 
 def merge(*items, **kwargs):
@@ -69,24 +354,71 @@ def merge(*items, **kwargs):
     return ''.join(res)
 
 
-@contextmanager
+class TryFit:
+    def __init__(self, it):
+        self.it = it
+        self.it_copy = it.copy()
+        self.success = True
+        self.fail = False
+
+    def __call__(self, *args, **kwargs):
+        return fit(self.it_copy, *args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.it.fill_from(self.it_copy)
+            return False
+        if issubclass(exc_type, NotFitException):
+            self.success = False
+            self.fail = True
+            return True
+        return False
+
+
 def try_fit(it):
-    it_copy = it.copy()
+    return TryFit(it)
 
-    def safe_fit(*args, **kwargs):
-        return fit(it_copy, *args, **kwargs)
 
-    safe_fit.success = True
-    safe_fit.fail = False
+def emit_list(items, join='', **kwargs):
+    for i, item in enumerate(items):
+        if i and join:
+            yield join
+        if isinstance(item, CodePart):
+            yield from item.emit(**kwargs)
+        else:
+            yield merge(item, **kwargs)
 
-    try:
-        yield safe_fit
-    except NotFitException:
-        safe_fit.success = False
-        safe_fit.fail = True
-        pass
-    else:
-        it.fill_from(it_copy)
+
+# Emitted text of a node. emit() may yield the emit() generator of a child instead of yielding from it, such children
+# are run here from an explicit stack, so the depth of the tree does not nest python generators
+def fragments(node, **kwargs):
+    stack = [node.emit(**kwargs)]
+    while stack:
+        for fragment in stack[-1]:
+            if type(fragment) is not str:
+                stack.append(fragment)
+                break
+            yield fragment
+        else:
+            stack.pop()
+
+
+# Writes fragments to a text stream, joining small ones into chunks of about buffer_size characters
+def write_fragments(stream, fragments, buffer_size=1 << 16):
+    buffer = []
+    size = 0
+    for fragment in fragments:
+        buffer.append(fragment)
+        size += len(fragment)
+        if size >= buffer_size:
+            stream.write(''.join(buffer))
+            buffer.clear()
+            size = 0
+    if buffer:
+        stream.write(''.join(buffer))
 
 
 def refactor_list(items, prefix='', join=None, **kwargs):
@@ -110,67 +442,244 @@ def add_word(need_add, word):
     return word
 
 
-def suppress_spaces(it):
-    with suppress(NotFitException):
-        from lang_objects import CSpaces
-        fit(it, CSpaces, pass_spaces=False)
-
-
 def have_item(it, item):
-    with try_fit(it) as f:
-        f(item)
-    return f.success
+    return try_parse(it, item) is not None
 
 
-def fit_choice(it, *templates):
+def match_choice(it, *templates):
+    try:
+        dispatcher = _dispatchers.get(templates)
+    except TypeError:
+        # Unhashable templates such as lists are tried one by one
+        dispatcher = None
+    else:
+        if dispatcher is None:
+            dispatcher = _dispatchers[templates] = Dispatcher(templates)
+    if dispatcher is not None:
+        templates = dispatcher.candidates(it.tokens.firsts[it.index])
+
     for temp in templates:
-        with try_fit(it) as f:
-            return f(temp)
+        res = try_parse(it, temp)
+        if res is not None:
+            return res
+    return None
 
-    raise NotFitException
 
+def fit_choice(it, *templates):
+    res = match_choice(it, *templates)
+    if res is None:
+        raise NotFitException
+    return res
 
-def fit_regex(it, regex):
-    match = re.match(regex, it.string)
-    if not match:
+
+# Regex over the source from the current token, returns the matched text. The match has to end at the end of a token
+# or in the trivia after it, the cursor moves to the next token
+def match_text(it, regex):
+    match = it.match(regex)
+    if match is None:
+        return None
+    tokens = it.tokens
+    end = match.end()
+    index = tokens.next_token(end)
+    if index > it.index and tokens.ends[index - 1] > end:
+        # Ends inside a token
+        return None
+    it.index = index
+    return match.group(0)
+
+
+# Matches the token with exactly this text
+def match_token_text(it, text):
+    tokens = it.tokens
+    index = it.index
+    if tokens.firsts[index] != text[0]:
+        return False
+    start = tokens.starts[index]
+    if tokens.ends[index] - start != len(text) or not it.text.startswith(text, start):
+        return False
+    it.index = index + 1
+    return True
+
+
+def rule_name(rule):
+    return getattr(rule, 'rule_name', None) or rule.__name__
+
+
+def all_rules(cls=CodePart):
+    # Every rule class defined so far, rules made by factories only after they were first asked for
+    for sub in cls.__subclasses__():
+        yield sub
+        yield from all_rules(sub)
+
+
+def node_attributes(node):
+    # Names of the attributes a node keeps its children and text in
+    names = getattr(node, '__dict__', None)
+    names = list(names) if names else []
+    for klass in type(node).__mro__:
+        slots = klass.__dict__.get('__slots__', ())
+        names += [slots] if isinstance(slots, str) else slots
+    return names
+
+
+def match_rule(it, rule):
+    context = it.context
+    if context.profiler is not None:
+        return context.profiler.match(it, rule, _match_rule)
+    # Leaves are matched directly, most rule applications are theirs
+    if not rule.memoize or (context.memo is None and context.budget is None):
+        return rule.match(it)
+    return _match_rule(it, rule)
+
+
+def _match_rule(it, rule):
+    context = it.context
+    if not rule.memoize:
+        return rule.match(it)
+    # Leaves are not counted as steps, every one of them is done by a counted rule in a bounded number of tokens
+    if context.budget is not None:
+        context.budget.charge()
+    memo = context.memo
+    if memo is None:
+        return rule.match(it)
+
+    start = it.index
+    entry = memo.get(rule, start)
+    if entry is not None:
+        node, end = entry
+        if node is not None:
+            it.index = end
+        return node
+
+    node = rule.match(it)
+    memo.put(rule, start, node, it.index)
+    return node
+
+
+# Driver of rules written as steps: a generator classmethod steps(cls, it) yielding the templates it needs and getting
+# the parsed node or None back. It returns the node, None or raises NotFitException on failure. Nested step rules are
+# pushed on a list instead of being called, so the nesting depth of the source is not limited by the python stack
+def match_steps(rule, it):
+    context = it.context
+    memo = context.memo
+    budget = context.budget
+    profiler = context.profiler
+    explicit = context.explicit_stack
+    stack = []
+    start = it.index
+    steps = rule.steps(it)
+    # Profiler frame of the nested rule being run, the outermost one is profiled by match_rule
+    frame = None
+    result = None
+    try:
+        while True:
+            try:
+                template = steps.send(result)
+            except (StopIteration, NotFitException) as stop:
+                result = getattr(stop, 'value', None)
+                if result is None:
+                    it.index = start
+                if not stack:
+                    return result
+                # The outermost rule is memorized by match_rule, nested ones here
+                if memo is not None and rule.memoize:
+                    memo.put(rule, start, result, it.index)
+                if frame is not None:
+                    profiler.leave(it, frame, result)
+                rule, start, steps, frame = stack.pop()
+                continue
+
+            if not explicit or type(template) is not type or template.steps is None:
+                result = try_parse(it, template)
+                continue
+            if budget is not None and template.memoize:
+                budget.charge()
+            nested = profiler.enter(it, template) if profiler is not None else None
+            if memo is not None and template.memoize:
+                entry = memo.get(template, it.index)
+                if entry is not None:
+                    result, end = entry
+                    if result is not None:
+                        it.index = end
+                    if nested is not None:
+                        profiler.leave(it, nested, result)
+                    continue
+            stack.append((rule, start, steps, frame))
+            rule = template
+            start = it.index
+            steps = rule.steps(it)
+            frame = nested
+            result = None
+    except BaseException:
+        # Frames of the nested rules end with the exception, the innermost first
+        if profiler is not None:
+            for frame in [frame] + [entry[3] for entry in reversed(stack)]:
+                if frame is not None:
+                    profiler.cancel(frame)
+        raise
+
+
+def apply_rule(it, rule):
+    node = match_rule(it, rule)
+    if node is None:
         raise NotFitException
-    value = match.group(0)
-    assert isinstance(value, str)
-    it.shift(len(value))
-    return value
+    return node
 
 
-def fit(it, template, block_it=False, allow_spaces=True, sep=None, pass_spaces=True):
-    if block_it:
-        it = it.copy()
-    if pass_spaces:
-        suppress_spaces(it)
+def _match_list(it, template, sep):
+    temp = template[0]
+    first = try_parse(it, temp)
+    if first is None:
+        return None
+
+    items = [first]
+    while True:
+        start = it.index
+        if sep and try_parse(it, sep) is None:
+            break
+        next_item = try_parse(it, temp)
+        if next_item is None:
+            it.index = start
+            break
+        items.append(next_item)
 
+    return items
+
+
+# Same as fit, but returns None instead of raising NotFitException and leaves it untouched on failure
+def try_parse(it, template, sep=None):
     if type(template) is type and issubclass(template, CodePart):
-        return template(it)
+        return match_rule(it, template)
+    if isinstance(template, (str, re.Pattern)):
+        return match_text(it, template)
+    if isinstance(template, list):
+        return _match_list(it, template, sep)
+    raise TypeError(template)
 
-    elif isinstance(template, str):
-        return fit_regex(it, template)
 
-    elif isinstance(template, list):
-        temp = template[0]
-        items = [fit(it, temp)]
-        while True:
-            next_item = None
-            with try_fit(it) as f:
-                if allow_spaces:
-                    suppress_spaces(it)
-
-                if sep:
-                    f(sep)
-                    if allow_spaces:
-                        suppress_spaces(it)
-                next_item = [f(temp)]
-
-            if not next_item:
-                break
-            items += next_item
+# Parses a rule class, a regex string or compiled pattern or a list [rule] of one or more rules separated by sep.
+# block_it, allow_spaces and pass_spaces are left from parsing over characters: whitespace is trivia between tokens
+# now, so the space flags do nothing, block_it still parses without moving it
+def fit(it, template, block_it=False, allow_spaces=True, sep=None, pass_spaces=True):
+    if block_it or not allow_spaces or not pass_spaces:
+        warnings.warn('fit() arguments block_it, allow_spaces and pass_spaces are deprecated', DeprecationWarning,
+                      stacklevel=2)
+        if block_it:
+            it = it.copy()
+    res = try_parse(it, template, sep=sep)
+    if res is None:
+        raise NotFitException
+    return res
+
+
+# Deprecated helpers of the character based parser, kept for custom rules. Whitespace and comments never reach the
+# rules, a regex is matched from the current token with fit(it, regex)
+def fit_regex(it, regex):
+    warnings.warn('fit_regex(it, regex) is deprecated, use fit(it, regex)', DeprecationWarning, stacklevel=2)
+    return fit(it, regex)
+
+
+def suppress_spaces(it):
+    warnings.warn('suppress_spaces() is deprecated, spaces are skipped by the lexer', DeprecationWarning, stacklevel=2)
+
 
-        return items
-    else:
-        raise TypeError(template)
@@ -0,0 +1,170 @@
+import json
+import time
+
+from parser_utils import rule_name
+
+
+def _characters(tokens, start, end):
+    # Characters of the source taken by the tokens start to end - 1, with the gaps between them
+    return tokens.ends[end - 1] - tokens.starts[start] if end > start else 0
+
+
+class RuleStats:
+    def __init__(self, name):
+        self.name = name
+        # ';' separates frames in collapsed stacks
+        self.frame_name = name.replace(';', 'semicolon')
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        # Characters of the source from the first to the last token of successful attempts
+        self.consumed = 0
+        # Characters parsed by failed attempts before they gave up, up to the end of the furthest token they reached
+        self.backtracked = 0
+        # Time spent in the rule itself and with everything it called, recursion is counted once
+        self.self_time = 0.0
+        self.total_time = 0.0
+
+    def to_dict(self):
+        res = dict(self.__dict__)
+        del res['frame_name']
+        return res
+
+
+# Collects per rule statistics when set as ParseContext.profiler, costs nothing when it is not set
+class RuleProfiler:
+    COLUMNS = ('attempts', 'successes', 'failures', 'consumed', 'backtracked', 'self_time', 'total_time')
+
+    def __init__(self):
+        self.stats = {}
+        # Call stacks are numbered as they are first seen, (number of the caller's stack, rule) -> number. Joined
+        # into 'Rule;Rule;Rule' only by stacks, rebuilding the path on every return is quadratic in the depth
+        self._paths = {}
+        # Caller's stack number and frame name, and self time of each stack number
+        self._path_names = []
+        self._path_times = []
+        # Frames of active rules, see enter
+        self._frames = []
+        self._active = {}
+
+    def match(self, it, rule, match_rule):
+        frame = self.enter(it, rule)
+        try:
+            node = match_rule(it, rule)
+        except BaseException:
+            self.cancel(frame)
+            raise
+        return self.leave(it, frame, node)
+
+    # match in two halves for rules that are not a python call of their own: the nested rules of match_steps start
+    # with enter and end with leave or, on an exception, with cancel
+    def enter(self, it, rule):
+        name = rule_name(rule)
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = RuleStats(name)
+        self._active[name] = self._active.get(name, 0) + 1
+        key = (self._frames[-1][6] if self._frames else -1, stats.frame_name)
+        path = self._paths.get(key)
+        if path is None:
+            path = self._paths[key] = len(self._path_names)
+            self._path_names.append(key)
+            self._path_times.append(0.0)
+        # [name, time of called rules, furthest index reached, stats, start index, start time, stack number]
+        frame = [stats.frame_name, 0.0, it.index, stats, it.index, time.perf_counter(), path]
+        self._frames.append(frame)
+        return frame
+
+    def _pop(self, frame):
+        elapsed = time.perf_counter() - frame[5]
+        self._active[frame[3].name] -= 1
+        self._frames.pop()
+        return elapsed
+
+    def cancel(self, frame):
+        self._pop(frame)
+
+    def leave(self, it, frame, node):
+        elapsed = self._pop(frame)
+        stats = frame[3]
+        start_index = frame[4]
+        tokens = it.tokens
+        stats.attempts += 1
+        if node is None:
+            stats.failures += 1
+            stats.backtracked += _characters(tokens, start_index, frame[2])
+            reached = frame[2]
+        else:
+            stats.successes += 1
+            stats.consumed += _characters(tokens, start_index, it.index)
+            reached = max(frame[2], it.index)
+
+        self_time = elapsed - frame[1]
+        stats.self_time += self_time
+        if not self._active[stats.name]:
+            stats.total_time += elapsed
+        self._path_times[frame[6]] += self_time
+
+        if self._frames:
+            parent = self._frames[-1]
+            parent[1] += elapsed
+            parent[2] = max(parent[2], reached)
+        return node
+
+    @property
+    def stacks(self):
+        # Collapsed call stack 'Rule;Rule;Rule' -> self time. A caller's stack is numbered before the stacks it calls
+        paths = []
+        for caller, name in self._path_names:
+            paths.append(f'{paths[caller]};{name}' if caller >= 0 else name)
+        return dict(zip(paths, self._path_times))
+
+    def sorted_stats(self, key='self_time'):
+        return sorted(self.stats.values(), key=lambda x: getattr(x, key), reverse=True)
+
+    def table(self, key='self_time', limit=None):
+        stats = self.sorted_stats(key)[:limit]
+        width = max([len(x.name) for x in stats] + [4])
+        lines = [f'{"rule":<{width}} ' + ' '.join(f'{column:>12}' for column in self.COLUMNS)]
+        for x in stats:
+            lines.append(f'{x.name:<{width}} ' + ' '.join(
+                f'{getattr(x, column):>12.4f}' if column.endswith('time') else f'{getattr(x, column):>12}'
+                for column in self.COLUMNS
+            ))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return {
+            'rules': [x.to_dict() for x in self.sorted_stats()],
+            'stacks': self.stacks,
+        }
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+    def write_collapsed(self, filename):
+        # Collapsed stack format of flamegraph.pl and speedscope, weights are microseconds
+        with open(filename, 'w') as f:
+            for path, seconds in sorted(self.stacks.items()):
+                f.write(f'{path} {max(1, round(seconds * 1e6))}\n')
+
+
+# Wall time of the stages of one run from the start of main.py, for --startup-profile
+class StartupProfile:
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.last = self.start
+        self.stages = []
+
+    def stage(self, name):
+        # Ends the stage named name, it started where the previous one ended
+        now = time.perf_counter()
+        self.stages.append((name, now - self.last))
+        self.last = now
+
+    def table(self):
+        width = max([len(name) for name, _ in self.stages] + [5])
+        lines = [f'{name:<{width}} {seconds * 1000:>9.2f} ms' for name, seconds in self.stages]
+        lines.append(f'{"total":<{width}} {(self.last - self.start) * 1000:>9.2f} ms')
+        return '\n'.join(lines)
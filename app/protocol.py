@@ -0,0 +1,63 @@
+import json
+import os
+import struct
+import tempfile
+
+# Frames of the obfuscation server: 4 byte big endian length, then a json object in utf-8.
+# Request: {"id": 1, "op": "obfuscate", "source": "...", "name": "/abs/file.cpp", "seed": "1", "memo_size": 4096}
+# or {"id": 1, "op": "ping"}. Response: {"id": 1, "code": "..."} or {"id": 1, "error": "..."}.
+# Responses on a connection come in the order of its requests, so a client may send many requests before reading
+PROTOCOL_VERSION = 1
+MAX_FRAME_SIZE = 256 * 2 ** 20
+_HEADER = struct.Struct('>I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def default_socket_path():
+    return os.path.join(tempfile.gettempdir(), f'cpp-obfuscator-{os.getuid()}.sock')
+
+
+def encode_frame(message):
+    data = json.dumps(message, ensure_ascii=False).encode('utf-8', 'surrogatepass')
+    if len(data) > MAX_FRAME_SIZE:
+        raise ProtocolError(f'frame of {len(data)} bytes is larger than {MAX_FRAME_SIZE}')
+    return _HEADER.pack(len(data)) + data
+
+
+def _decode(data):
+    try:
+        message = json.loads(data.decode('utf-8', 'surrogatepass'))
+    except ValueError as e:
+        raise ProtocolError(f'bad frame: {e}')
+    if not isinstance(message, dict):
+        raise ProtocolError('frame is not a json object')
+    return message
+
+
+async def read_frame(reader):
+    # asyncio.IncompleteReadError when the connection is closed
+    size, = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError(f'frame of {size} bytes is larger than {MAX_FRAME_SIZE}')
+    return _decode(await reader.readexactly(size))
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 2 ** 20))
+        if not chunk:
+            raise ConnectionError('connection closed by the server')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError(f'frame of {size} bytes is larger than {MAX_FRAME_SIZE}')
+    return _decode(_recv_exactly(sock, size))
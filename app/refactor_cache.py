@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+
+# Bump when the stored output format changes
+CACHE_FORMAT = 1
+
+
+def span_digest(text):
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+# On disk cache of refactored top level elements, keyed by a hash of the element source and the obfuscation salt
+# (settings, seed, grammar). Entries are evicted least recently used first when max_bytes of output is exceeded.
+# It also keeps, per source name, the element spans of the last run so unchanged spans are not parsed again.
+# Writes are buffered and done in one short transaction by commit() or every FLUSH_ENTRIES of them, so workers sharing
+# the database do not wait for each other while they refactor
+class RefactorCache:
+    DEFAULT_MAX_BYTES = 256 * 2 ** 20
+    # Shorter elements are cheaper to refactor again than to look up
+    MIN_CACHED_LENGTH = 32
+    FLUSH_ENTRIES = 256
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        import sqlite3
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(os.path.join(path, 'refactor_cache.sqlite3'), timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries '
+                        '(key TEXT PRIMARY KEY, output TEXT, size INTEGER, used INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS manifests (name TEXT PRIMARY KEY, spans TEXT)')
+        self.db.commit()
+        self.clock = self.db.execute('SELECT COALESCE(MAX(used), 0) FROM entries').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Buffered writes: new entries key -> (output, used), uses of stored entries key -> used, manifests
+        self.added = {}
+        self.used = {}
+        self.manifests = {}
+
+    @staticmethod
+    def salt(*parts):
+        return json.dumps([CACHE_FORMAT, *parts], sort_keys=True, default=str)
+
+    @staticmethod
+    def key(salt, digest):
+        return hashlib.sha1(f'{salt}:{digest}'.encode()).hexdigest()
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def get(self, key):
+        added = self.added.get(key)
+        if added is not None:
+            self.hits += 1
+            self.added[key] = (added[0], self._tick())
+            return added[0]
+        row = self.db.execute('SELECT output FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used[key] = self._tick()
+        self._buffered()
+        return row[0]
+
+    def put(self, key, output):
+        self.added[key] = (output, self._tick())
+        self._buffered()
+
+    def _buffered(self):
+        if len(self.added) + len(self.used) >= self.FLUSH_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        # Writes the buffered changes in one transaction
+        if not (self.added or self.used or self.manifests):
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                [(key, output, len(output), used) for key, (output, used) in self.added.items()])
+            self.db.executemany('UPDATE entries SET used = ? WHERE key = ?',
+                                [(used, key) for key, used in self.used.items()])
+            self.db.executemany('INSERT OR REPLACE INTO manifests VALUES (?, ?)', self.manifests.items())
+        self.added.clear()
+        self.used.clear()
+        self.manifests.clear()
+
+    def _evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY used').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+            self.evictions += 1
+
+    def load_manifest(self, name):
+        if name in self.manifests:
+            return json.loads(self.manifests[name])
+        row = self.db.execute('SELECT spans FROM manifests WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_manifest(self, name, spans):
+        self.manifests[name] = json.dumps(spans)
+
+    def commit(self):
+        self.flush()
+        with self.db:
+            self._evict()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f'cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), {self.evictions} evicted'
+
+
+def align_spans(source, manifest):
+    # Splits previous spans [length, digest] into those still found unchanged at the start and at the end of source.
+    # Returns (prefix spans, suffix spans) as (start, end) pairs. The last prefix span is dropped when anything changed,
+    # its parse may depend on the text after it
+    prefix = []
+    pos = 0
+    for length, digest in manifest:
+        if pos + length > len(source) or span_digest(source[pos:pos + length]) != digest:
+            break
+        prefix.append((pos, pos + length))
+        pos += length
+
+    suffix = []
+    end = len(source)
+    for length, digest in reversed(manifest[len(prefix):]):
+        if end - length < pos or span_digest(source[end - length:end]) != digest:
+            break
+        suffix.append((end - length, end))
+        end -= length
+    suffix.reverse()
+
+    if len(prefix) < len(manifest) or pos < len(source):
+        prefix = prefix[:-1]
+    return prefix, suffix
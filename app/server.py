@@ -0,0 +1,171 @@
+#!/bin/python3
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from batch import init_worker, obfuscate_source
+from protocol import PROTOCOL_VERSION, ProtocolError, default_socket_path, encode_frame, read_frame
+from refactor_cache import RefactorCache
+
+
+# Keeps warm worker processes with the grammar imported and serves obfuscation requests over a unix socket.
+# At most max_pending requests are in the pool or waiting for it, after that connections are not read any more
+# until a request is done, so clients block on their full socket buffers instead of growing the server queue
+class ObfuscationServer:
+    def __init__(self, path, jobs=None, max_pending=None, cache_dir=None, cache_size=None, tree_cache_dir=None,
+                 max_steps=None, max_seconds=None, compiled_grammar=False):
+        self.path = path
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_pending = max_pending or self.jobs * 2
+        self.executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=init_worker,
+                                            initargs=(cache_dir, cache_size, tree_cache_dir, compiled_grammar))
+        self.requests = 0
+        # Parse budget of every request, a stuck element must not hold a worker
+        self.budget = {key: value for key, value in (('max_steps', max_steps), ('max_seconds', max_seconds))
+                       if value is not None}
+        self._slots = None
+        self._server = None
+
+    async def serve(self):
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._remove_stale_socket()
+        # Workers are started before the socket is opened, the first request does not pay for the imports
+        await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(self.executor, obfuscate_source, '')
+                               for _ in range(self.jobs)))
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.path)
+            except OSError:
+                os.unlink(self.path)
+                return
+        raise RuntimeError(f'server is already running on {self.path}')
+
+    async def _handle(self, reader, writer):
+        # Requests of a connection are submitted as they come, the responses are written by _respond in order
+        responses = asyncio.Queue()
+        responder = asyncio.create_task(self._respond(responses, writer))
+        try:
+            while True:
+                try:
+                    message = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ProtocolError as e:
+                    await responses.put((None, self._done({'error': str(e)})))
+                    break
+                await self._slots.acquire()
+                responses.put_nowait((message.get('id'), self._submit(message)))
+        finally:
+            responses.put_nowait(None)
+            await responder
+            writer.close()
+
+    async def _respond(self, responses, writer):
+        while True:
+            item = await responses.get()
+            if item is None:
+                break
+            request_id, future = item
+            try:
+                response = await future
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            if writer.is_closing():
+                continue
+            try:
+                writer.write(encode_frame({'id': request_id, **response}))
+                await writer.drain()
+            except (ConnectionError, ProtocolError):
+                writer.close()
+
+    def _done(self, response):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(response)
+        return future
+
+    def _submit(self, message):
+        # Returns a future of the response, the slot taken by _handle is released when it is done
+        op = message.get('op', 'obfuscate')
+        if op != 'obfuscate' or not isinstance(message.get('source'), str):
+            self._slots.release()
+        if op == 'ping':
+            return self._done({'version': PROTOCOL_VERSION, 'jobs': self.jobs, 'requests': self.requests})
+        if op != 'obfuscate' or not isinstance(message.get('source'), str):
+            return self._done({'error': f'bad request: {op}'})
+
+        self.requests += 1
+        kwargs = {key: message[key] for key in ('name', 'seed', 'memo_size') if message.get(key) is not None}
+        kwargs.update(self.budget)
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(obfuscate_source, message['source'], **kwargs)
+        )
+        future.add_done_callback(lambda _: self._slots.release())
+        return asyncio.ensure_future(self._response(future))
+
+    @staticmethod
+    async def _response(future):
+        code, error = await future
+        return {'error': error} if error else {'code': code}
+
+
+parser = argparse.ArgumentParser(description='Serve c++ obfuscation requests over a unix socket, see client.py')
+parser.add_argument('--socket', metavar='path', default=default_socket_path(),
+                    help=f'Unix socket path. Default {default_socket_path()}')
+parser.add_argument('-j', metavar='jobs', type=int, default=None, help='Worker processes. Default cpu count')
+parser.add_argument('--max-pending', metavar='requests', type=int, default=None,
+                    help='Requests in work or waiting for a worker before clients are not read. Default 2 * jobs')
+parser.add_argument('--cache', metavar='directory', default=None,
+                    help='Directory of the incremental cache of refactored elements')
+parser.add_argument('--cache-size', metavar='MB', type=int, default=RefactorCache.DEFAULT_MAX_BYTES // 2 ** 20,
+                    help='Max size of cached output in megabytes')
+parser.add_argument('--tree-cache', metavar='directory', default=None,
+                    help='Directory of parse trees, sources parsed before are loaded instead of parsed')
+parser.add_argument('--max-steps', metavar='steps', type=int, default=None,
+                    help='Parse steps allowed for one top level element, an element over it is passed through unchanged')
+parser.add_argument('--max-seconds', metavar='seconds', type=float, default=None,
+                    help='Parse time allowed for one top level element, same as --max-steps')
+parser.add_argument('--compiled-grammar', action='store_true',
+                    help='Parse with the grammar compiled into python functions by grammar_compiler.py')
+
+
+async def _serve(server):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, server.close)
+    await server.serve()
+
+
+def main(args):
+    server = ObfuscationServer(args.socket, jobs=args.j, max_pending=args.max_pending, cache_dir=args.cache,
+                               cache_size=args.cache_size * 2 ** 20, tree_cache_dir=args.tree_cache,
+                               max_steps=args.max_steps, max_seconds=args.max_seconds,
+                               compiled_grammar=args.compiled_grammar)
+    print(f'serving on {args.socket} with {server.jobs} workers')
+    asyncio.run(_serve(server))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,384 @@
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+import warnings
+from array import array
+from random import Random
+
+from lexer import WORD, identifiers, split_words
+
+# Two phase renaming of identifiers over a whole project. The first phase parses every file and collects the names
+# its classes, functions, arguments and variables declare, they get new names in one symbol index file. The second
+# phase obfuscates the files with every identifier found in the index replaced, workers map the index read only.
+# Identifiers are replaced as tokens, in code no rule recognized and in function bodies too, so every use of a name
+# changes with its declaration. Types are not known, so a name after . or -> is renamed only if a class or struct of
+# the project declares such a member, and a name after X:: only if X is a class, struct or namespace of the project:
+# v.size() keeps size of the library even when the project declares a variable size
+
+# Bump when the file layout changes
+SYMBOLS_FORMAT = 2
+_MAGIC = b'CSY' + (b'l' if sys.byteorder == 'little' else b'b')
+# magic, format, number of names, sha1 of the names, their new names and flags
+_HEADER = struct.Struct('<4sII20s')
+
+# Keywords of c++ are neither declared names nor new names
+CPP_KEYWORDS = frozenset('''
+    alignas alignof and and_eq asm auto bitand bitor bool break case catch char char8_t char16_t char32_t class compl
+    concept const consteval constexpr constinit const_cast continue co_await co_return co_yield decltype default delete
+    do double dynamic_cast else enum explicit export extern false float for friend goto if inline int long mutable
+    namespace new noexcept not not_eq nullptr operator or or_eq private protected public register reinterpret_cast
+    requires return short signed sizeof static static_assert static_cast struct switch template this thread_local throw
+    true try typedef typeid typename union unsigned using virtual void volatile wchar_t while xor xor_eq
+    final override
+'''.split())
+# Names the program is linked by
+RESERVED_NAMES = frozenset(('main',))
+# New names are the prefix and a number in base 36
+NAME_PREFIX = 'v'
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+_NAME_START = frozenset('_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+# Token after the name of a declared variable: int a = 1; int a[2]; int a(1); int a{1}; int a, b;
+_DECLARATION_END = frozenset('=;,[({')
+# Include lines are read from the text, CInclude only parses <name> and "name" and the raw text holds the rest
+_INCLUDE = re.compile(r'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"\n]*)[>"]', re.M)
+# Structs and unions are not parsed, their members are found in the text. Classes are too, for the ones the grammar
+# gave up on
+_AGGREGATE = re.compile(r'\b(?:class|struct|union)[ \t\n]+([a-zA-Z_]\w*)[^;{}()]*\{')
+_NAMESPACE = re.compile(r'\bnamespace[ \t\n]+([a-zA-Z_][\w:]*)[ \t\n]*\{')
+# Flags of an index entry: the name is a member of a class or struct of the project, the name is a class, struct or
+# namespace of the project. Names that are only scopes are in the index with their own name
+MEMBER = 1
+SCOPE = 2
+
+
+def declared_names(obfuscator):
+    # Names declared by the parsed spans of an obfuscator, names of members and names of classes
+    from lang_objects import CBody, CClass, CFuncArgument, CFuncArguments, CFuncName, CTypeFull, CVariableInit
+    from parser_utils import CodePart, TextPart, node_attributes
+
+    # Statements, types and text hold no declarations the grammar parses, they are not walked
+    skipped = (CBody, CTypeFull, TextPart)
+    tokens = obfuscator.context.token_stream(obfuscator.source_code)
+    names = set()
+    members = set()
+    classes = set()
+    # Nodes with True for the ones a class declares
+    stack = [(part, False) for _, _, part in obfuscator.spans if isinstance(part, CodePart)]
+    while stack:
+        node, member = stack.pop()
+        if isinstance(node, (list, tuple)):
+            stack += [(item, member) for item in node]
+            continue
+        if not isinstance(node, CodePart) or isinstance(node, skipped):
+            continue
+        name = None
+        if isinstance(node, CClass):
+            name = node.name.value
+            classes.add(name)
+        elif isinstance(node, CFuncArgument):
+            name = node.name.value
+        elif isinstance(node, CFuncName):
+            # Operators have no name, the class before :: is a use of a name declared elsewhere
+            if node.c_name.word is not None:
+                name = node.c_name.word.value
+                if node.c_class is not None:
+                    members.add(name)
+        elif isinstance(node, CVariableInit):
+            # The name is the first token of the expression, if the expression is a declaration at all
+            index = tokens.next_token(node.name.start)
+            if tokens.kinds[index] == WORD and tokens.firsts[index + 1] in _DECLARATION_END:
+                name = tokens.token_text(index)
+        if name is not None:
+            names.add(name)
+            if member:
+                members.add(name)
+        # Arguments of methods are not members, everything else in a class is
+        member = isinstance(node, CClass) or member and not isinstance(node, CFuncArguments)
+        for attribute in node_attributes(node):
+            stack.append((getattr(node, attribute, None), member))
+    return names, members, classes
+
+
+def aggregates(tokens):
+    # Names of the classes, structs and unions of a source and the names their bodies seem to declare: identifiers
+    # followed by one of _DECLARATION_END, as in int x; int x[2]; void f();
+    text = tokens.text
+    names = set()
+    members = set()
+    for match in _AGGREGATE.finditer(text):
+        index = tokens.next_token(match.start())
+        if tokens.starts[index] != match.start():
+            # In a comment or a literal
+            continue
+        opening = tokens.next_token(match.end() - 1)
+        closing = tokens.pairs[opening]
+        if closing < 0:
+            continue
+        names.add(match.group(1))
+        for index in range(opening + 1, closing):
+            if tokens.kinds[index] == WORD and tokens.firsts[index + 1] in _DECLARATION_END:
+                members.add(tokens.token_text(index))
+    return names, members
+
+
+def included_files(source, filename, include_dirs):
+    # Paths of the files source includes, found next to filename for "name" and in include_dirs. Returns the found
+    # paths, the identifiers of the include lines, such as stdio and h of <stdio.h>, and the include lines not found
+    found = []
+    words = set()
+    missing = set()
+    directory = os.path.dirname(os.path.abspath(filename))
+    for quote, name in _INCLUDE.findall(source):
+        words |= identifiers(name)
+        for root in ([directory] if quote == '"' else []) + list(include_dirs):
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                found.append(os.path.abspath(path))
+                break
+        else:
+            missing.add(f'<{name}>' if quote == '<' else f'"{name}"')
+    return found, words, missing
+
+
+# Result of the first phase for one file. Its sets are merged over the project by build_index
+class Collected:
+    __slots__ = ('declared', 'members', 'scopes', 'words', 'includes', 'include_words', 'missing')
+
+    def __init__(self, declared=(), members=(), scopes=(), words=(), includes=(), include_words=(), missing=()):
+        # Declared names, the ones declared as members, names of classes, structs and namespaces
+        self.declared = set(declared)
+        self.members = set(members)
+        self.scopes = set(scopes)
+        # Identifiers of the file, new names are none of them
+        self.words = set(words)
+        # Included files found, identifiers of the include lines and the include lines not found
+        self.includes = list(includes)
+        self.include_words = set(include_words)
+        self.missing = set(missing)
+
+
+def collect(obfuscator, filename, include_dirs=()):
+    # First phase for one parsed file
+    source = obfuscator.source_code
+    names, members, classes = declared_names(obfuscator)
+    aggregate_names, aggregate_members = aggregates(obfuscator.context.token_stream(source))
+    includes, include_words, missing = included_files(source, filename, include_dirs)
+    scopes = classes | aggregate_names | {part for name in _NAMESPACE.findall(source) for part in name.split('::')}
+    return Collected(names, members | aggregate_members, scopes, identifiers(source), includes, include_words,
+                     missing)
+
+
+def collect_file(filename, include_dirs=(), **kwargs):
+    from code_obfuscator import CppCodeObfuscator
+
+    obfuscator = CppCodeObfuscator.from_file(filename, **kwargs)
+    if not obfuscator.load_tree():
+        obfuscator.parse()
+    return collect(obfuscator, filename, include_dirs)
+
+
+def header_names(headers, include_dirs=()):
+    # Identifiers of headers outside of the project and of everything they include. They are not parsed, the grammar
+    # is not meant for library code, every identifier of them is kept as it is
+    names = set()
+    seen = set()
+    stack = list(headers)
+    while stack:
+        path = stack.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            with open(path, 'r', errors='replace') as f:
+                text = f.read()
+        except OSError:
+            continue
+        includes, words, _ = included_files(text, path, include_dirs)
+        names |= identifiers(text) | words
+        stack += includes
+    return names
+
+
+def new_name(number):
+    digits = ''
+    while True:
+        number, digit = divmod(number, len(_DIGITS))
+        digits = _DIGITS[digit] + digits
+        if not number:
+            return NAME_PREFIX + digits
+
+
+def assign_names(declared, taken, seed=None):
+    # Mapping of the declared names to new names. The order of numbering depends on the seed, new names are never
+    # an identifier of taken
+    names = sorted(declared)
+    (Random(seed) if seed is not None else Random()).shuffle(names)
+    mapping = {}
+    number = 0
+    for name in names:
+        while True:
+            target = new_name(number)
+            number += 1
+            if target not in taken:
+                break
+        mapping[name] = target
+    return mapping
+
+
+def write_index(filename, mapping, flags=None):
+    # Names sorted by their utf-8 bytes, so a lookup is a binary search over the mapped file. Layout: header, offsets
+    # of the names, offsets of the new names, a byte of flags per name, names, new names
+    flags = flags or {}
+    items = sorted((name.encode(), target.encode(), flags.get(name, 0)) for name, target in mapping.items())
+    names = b''.join(name for name, _, _ in items)
+    targets = b''.join(target for _, target, _ in items)
+    name_offsets = array('I', [0])
+    target_offsets = array('I', [0])
+    for name, target, _ in items:
+        name_offsets.append(name_offsets[-1] + len(name))
+        target_offsets.append(target_offsets[-1] + len(target))
+    name_flags = bytes(flag for _, _, flag in items)
+    digest = hashlib.sha1(names + b'\0' + targets + b'\0' + name_flags)
+    for offsets in (name_offsets, target_offsets):
+        digest.update(offsets.tobytes())
+    temp = f'{filename}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, SYMBOLS_FORMAT, len(items), digest.digest()))
+        f.write(name_offsets.tobytes())
+        f.write(target_offsets.tobytes())
+        f.write(name_flags)
+        f.write(names)
+        f.write(targets)
+    os.replace(temp, filename)
+
+
+# Symbol index file mapped read only. Lookups are memorized per process, most identifiers repeat many times
+class SymbolIndex:
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, symbols_format, self.count, digest = _HEADER.unpack_from(self.data)
+        if (magic, symbols_format) != (_MAGIC, SYMBOLS_FORMAT):
+            self.data.close()
+            raise ValueError(f'{filename} is not a symbol index of format {SYMBOLS_FORMAT}')
+        # Part of the refactor cache key, output renamed with another index is not reused
+        self.digest = digest.hex()
+        view = memoryview(self.data)
+        size = 4 * (self.count + 1)
+        self.name_offsets = view[_HEADER.size:_HEADER.size + size].cast('I')
+        self.target_offsets = view[_HEADER.size + size:_HEADER.size + 2 * size].cast('I')
+        self.flags_start = _HEADER.size + 2 * size
+        self.names_start = self.flags_start + self.count
+        self.targets_start = self.names_start + self.name_offsets[self.count]
+        # Memo of lookups: a piece maps to its new name, or to itself when it is not renamed, and to its flags
+        self.found = {}
+        self.found_flags = {}
+
+    def __len__(self):
+        return self.count
+
+    def _name(self, index):
+        return self.data[self.names_start + self.name_offsets[index]:self.names_start + self.name_offsets[index + 1]]
+
+    def _find(self, name):
+        # Position of name in the index or None
+        key = name.encode('utf-8', 'surrogatepass')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count or self._name(low) != key:
+            return None
+        return low
+
+    def _lookup(self, name):
+        index = self._find(name) if name[0] in _NAME_START else None
+        if index is None:
+            self.found[name] = name
+            return
+        self.found[name] = self.data[self.targets_start + self.target_offsets[index]:
+                                     self.targets_start + self.target_offsets[index + 1]].decode()
+        self.found_flags[name] = self.data[self.flags_start + index]
+
+    def get(self, name, default=None):
+        # New name of name, default if it is not renamed
+        if name not in self.found:
+            self._lookup(name)
+        target = self.found[name]
+        return default if target == name else target
+
+    def flags(self, name):
+        if name not in self.found:
+            self._lookup(name)
+        return self.found_flags.get(name, 0)
+
+    def rename(self, text):
+        # Replaces the identifiers of text, literals, numbers and comments map to themselves. Only pieces not seen
+        # before are searched, the rest is mapped by the memo in one pass. Renamed names after . -> and :: are then
+        # checked against their flags
+        parts = split_words(text)
+        pieces = parts[1::2]
+        found = self.found
+        for piece in set(pieces).difference(found):
+            self._lookup(piece)
+        renamed = list(map(found.__getitem__, pieces))
+        for number, target in enumerate(renamed):
+            if target is not pieces[number] and not self._renamed_after(parts, 2 * number + 1):
+                renamed[number] = pieces[number]
+        parts[1::2] = renamed
+        return ''.join(parts)
+
+    def _renamed_after(self, parts, index):
+        # Whether the identifier parts[index] is renamed where it is, by the punctuation before it
+        before = parts[index - 1].strip()
+        if before.endswith('->') or before.endswith('.') and not before.endswith('...'):
+            return bool(self.flags(parts[index]) & MEMBER)
+        if not before.endswith('::'):
+            return True
+        if before == '::' and index > 1:
+            return bool(self.flags(parts[index - 2]) & SCOPE)
+        if before[:-2].rstrip().endswith('>'):
+            # Scope is a template, its name is not next to the ::
+            return bool(self.flags(parts[index]) & MEMBER)
+        # Global scope, as in ::name
+        return True
+
+    def close(self):
+        self.name_offsets.release()
+        self.target_offsets.release()
+        self.data.close()
+
+
+def build_index(filename, files, collected, include_dirs=(), seed=None, key_words=()):
+    # Rest of the first phase: collected are the results of collect_file for files, in any order. Writes the index
+    # to filename and returns the number of renamed names
+    result = Collected()
+    for item in collected:
+        for field in Collected.__slots__:
+            value = getattr(result, field)
+            if isinstance(value, set):
+                value |= getattr(item, field)
+            else:
+                value += getattr(item, field)
+    if result.missing:
+        warnings.warn(f'included files not found, their names can be renamed: {", ".join(sorted(result.missing))}. '
+                      f'Pass their directories with -I', stacklevel=2)
+    # Headers of the project are renamed with it, the others only are read
+    kept = result.include_words | header_names(set(result.includes) - {os.path.abspath(path) for path in files},
+                                               include_dirs)
+    kept |= set(key_words) | CPP_KEYWORDS | RESERVED_NAMES
+    mapping = assign_names(result.declared - kept, result.words | kept, seed)
+    renamed = len(mapping)
+    flags = {name: MEMBER for name in result.members & mapping.keys()}
+    for name in result.scopes:
+        mapping.setdefault(name, name)
+        flags[name] = flags.get(name, 0) | SCOPE
+    write_index(filename, mapping, flags)
+    return renamed
@@ -0,0 +1,300 @@
+import ast
+import gc
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from lang_objects import CClassSection, specific_symbol, specific_word
+from parser_utils import CodePart, TextPart, all_rules, rule_name
+from refactor_cache import span_digest
+
+# Bump when the file layout or the record encoding changes
+TREE_FORMAT = 1
+_MAGIC = b'CPT' + (b'l' if sys.byteorder == 'little' else b'b')
+# magic, format, grammar version and source digest as raw sha1, byte lengths of kind and string tables, records
+_HEADER = struct.Struct('<4sI20s20sIII')
+
+# Records are int32. A node is its kind id (>= 0) followed by its fields, other values start with a negative tag.
+# Text of TextPart nodes is one field: SPAN start end of the source or STR of a detached string
+_NONE = -1
+_FALSE = -2
+_TRUE = -3
+# Slot that was never assigned
+_UNSET = -4
+_STR = -5
+_LIST = -6
+_TUPLE = -7
+_SPAN = -8
+# Shared node of an interned rule, such as specific_symbol('(')
+_FLYWEIGHT = -9
+_INT = -10
+
+# Rules created at call time are recreated from their names
+_FACTORIES = {
+    'SpecificSymbol': specific_symbol,
+    'SpecificWord': specific_word,
+    'CClassParticularSection': CClassSection.generate_class_section,
+}
+_TEXT_FIELDS = frozenset(('source', 'start', 'end'))
+_fields_cache = {}
+
+
+def _fields(cls):
+    # Slots of a rule in a fixed order, the text slots of TextPart are stored apart
+    fields = _fields_cache.get(cls)
+    if fields is None:
+        fields = []
+        for klass in reversed(cls.__mro__):
+            slots = klass.__dict__.get('__slots__', ())
+            fields += [slots] if isinstance(slots, str) else [x for x in slots if x not in _TEXT_FIELDS]
+        fields = _fields_cache[cls] = tuple(fields)
+    return fields
+
+
+def resolve_rule(name, rules=None):
+    # Rule class by its rule_name, None if the grammar has no such rule any more
+    if rules is not None and name in rules:
+        return rules[name]
+    factory_name, _, arg = name.partition('(')
+    if arg and factory_name in _FACTORIES:
+        return _FACTORIES[factory_name](ast.literal_eval(arg[:-1]))
+    for rule in all_rules():
+        if rule_name(rule) == name:
+            return rule
+    return None
+
+
+class _Encoder:
+    def __init__(self, source):
+        self.source = source
+        self.records = array('i')
+        self.kinds = {}
+        self.strings = {}
+
+    def kind(self, cls):
+        kind = self.kinds.get(cls)
+        if kind is None:
+            kind = self.kinds[cls] = len(self.kinds)
+        return kind
+
+    def string(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def value(self, value):
+        records = self.records
+        if value is None:
+            records.append(_NONE)
+        elif value is True or value is False:
+            records.append(_TRUE if value else _FALSE)
+        elif isinstance(value, CodePart):
+            self.node(value)
+        elif isinstance(value, str):
+            records.extend((_STR, self.string(value)))
+        elif isinstance(value, (list, tuple)):
+            records.extend((_LIST if isinstance(value, list) else _TUPLE, len(value)))
+            for item in value:
+                self.value(item)
+        elif type(value) is int:
+            records.extend((_INT, value))
+        else:
+            raise TypeError(value)
+
+    def node(self, node):
+        cls = type(node)
+        records = self.records
+        if getattr(cls, 'node', None) is node:
+            records.extend((_FLYWEIGHT, self.kind(cls)))
+            return
+        records.append(self.kind(cls))
+        if isinstance(node, TextPart):
+            source = getattr(node, 'source', None)
+            if source is None:
+                records.append(_UNSET)
+            elif source is self.source:
+                records.extend((_SPAN, node.start, node.end))
+            else:
+                records.extend((_STR, self.string(node.value)))
+        for field in _fields(cls):
+            value = getattr(node, field, _UNSET)
+            if value is _UNSET:
+                records.append(_UNSET)
+            else:
+                self.value(value)
+
+
+def encode_tree(source, spans, version):
+    # Bytes of the spans (start, end, node or trivia text) of a parsed source
+    encoder = _Encoder(source)
+    records = encoder.records
+    records.append(len(spans))
+    for start, end, part in spans:
+        records.extend((start, end))
+        if isinstance(part, str):
+            records.extend((_SPAN, start, end))
+        else:
+            encoder.node(part)
+
+    kinds = json.dumps([rule_name(cls) for cls in encoder.kinds]).encode()
+    strings = json.dumps(list(encoder.strings), ensure_ascii=False).encode('utf-8', 'surrogatepass')
+    pad = b'\0' * (-(_HEADER.size + len(kinds) + len(strings)) % 4)
+    header = _HEADER.pack(_MAGIC, TREE_FORMAT, bytes.fromhex(version), bytes.fromhex(span_digest(source)),
+                          len(kinds), len(strings) + len(pad), len(records))
+    return b''.join((header, kinds, strings, pad, records.tobytes()))
+
+
+def decode_tree(source, data, version):
+    # Spans stored by encode_tree, None when data is for another source, grammar or format
+    if len(data) < _HEADER.size:
+        return None
+    magic, tree_format, grammar, digest, kinds_size, strings_size, count = _HEADER.unpack_from(data)
+    if (magic, tree_format, grammar.hex()) != (_MAGIC, TREE_FORMAT, version) or digest.hex() != span_digest(source):
+        return None
+    pos = _HEADER.size
+    rules = {rule_name(rule): rule for rule in all_rules()}
+    kinds = [resolve_rule(name, rules) for name in json.loads(bytes(data[pos:pos + kinds_size]))]
+    if None in kinds:
+        return None
+    pos += kinds_size
+    strings = json.loads(bytes(data[pos:pos + strings_size]).rstrip(b'\0').decode('utf-8', 'surrogatepass'))
+    pos += strings_size
+    # Records are read from the mapped file as they are decoded, not copied into a list of ints first
+    with memoryview(data) as view, view[pos:pos + count * 4] as record_bytes, record_bytes.cast('i') as records:
+        return _decode_records(source, records, kinds, strings)
+
+
+def _decode_records(source, records, kinds, strings):
+    fields = [_fields(cls) for cls in kinds]
+    is_text = [issubclass(cls, TextPart) for cls in kinds]
+    constants = {_NONE: None, _FALSE: False, _TRUE: True, _UNSET: _UNSET}
+    next_record = iter(records).__next__
+
+    def value():
+        tag = next_record()
+        if tag >= 0:
+            cls = kinds[tag]
+            node = cls.__new__(cls)
+            if is_text[tag]:
+                text = next_record()
+                if text == _SPAN:
+                    node.source = source
+                    node.start = next_record()
+                    node.end = next_record()
+                elif text == _STR:
+                    node.value = strings[next_record()]
+            for field in fields[tag]:
+                item = value()
+                if item is not _UNSET:
+                    setattr(node, field, item)
+            return node
+        if tag in constants:
+            return constants[tag]
+        if tag == _SPAN:
+            return source[next_record():next_record()]
+        if tag == _STR:
+            return strings[next_record()]
+        if tag == _LIST:
+            return [value() for _ in range(next_record())]
+        if tag == _TUPLE:
+            return tuple(value() for _ in range(next_record()))
+        if tag == _FLYWEIGHT:
+            return kinds[next_record()].node
+        if tag == _INT:
+            return next_record()
+        raise ValueError(f'bad record {tag}')
+
+    spans = []
+    # Only new nodes are allocated, there are no cycles for the collector to find
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(next_record()):
+            start = next_record()
+            end = next_record()
+            spans.append((start, end, value()))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return spans
+
+
+# Directory of parsed trees, one memory mapped file per source and grammar version. Least recently used files are
+# removed when max_bytes is exceeded
+class TreeCache:
+    DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+    # The directory is scanned again after max_bytes / SCAN_PARTS bytes are stored. Processes sharing it do not see
+    # the files of each other between the scans
+    SCAN_PARTS = 16
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Bytes of the files at the last scan, None before the first one, and bytes stored since
+        self.scanned_bytes = None
+        self.stored_bytes = 0
+
+    def filename(self, source, version):
+        return os.path.join(self.path, span_digest(f'{version}:{span_digest(source)}') + '.tree')
+
+    def load(self, source, version):
+        # Spans of the parsed source, None on a miss
+        filename = self.filename(source, version)
+        spans = None
+        try:
+            with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                spans = decode_tree(source, data, version)
+            os.utime(filename)
+        except (OSError, ValueError, IndexError, StopIteration, RecursionError):
+            spans = None
+        if spans is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return spans
+
+    def store(self, source, spans, version):
+        try:
+            data = encode_tree(source, spans, version)
+        except (TypeError, RecursionError):
+            # A node keeps a value the format has no record for or the tree is nested too deep for the encoder,
+            # the source is parsed every time
+            return
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp, self.filename(source, version))
+        # A replaced file is counted twice, which only makes the next scan come sooner
+        self.stored_bytes += len(data)
+        if (self.scanned_bytes is None or self.scanned_bytes + self.stored_bytes > self.max_bytes
+                or self.stored_bytes > self.max_bytes // self.SCAN_PARTS):
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.tree'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        # A full cache is emptied by one part more, or every store after it would scan the directory again
+        limit = self.max_bytes - self.max_bytes // self.SCAN_PARTS if total > self.max_bytes else total
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            os.unlink(path)
+            total -= size
+        self.scanned_bytes = total
+        self.stored_bytes = 0
+
+    def stats(self):
+        return f'tree cache: {self.hits} hits, {self.misses} misses'
@@ -1,12 +1,12 @@
-from random import randint
+# Random helpers take the random.Random of the obfuscation, the module wide random stream is never used
 
 
-def rand_chance(how_many, from_amount):
-    return randint(1, from_amount) < how_many
+def rand_chance(rng, how_many, from_amount):
+    return rng.randint(1, from_amount) < how_many
 
 
-def throw_coin():
-    return rand_chance(1, 2)
+def throw_coin(rng):
+    return rand_chance(rng, 1, 2)
 
 
 def str_indent(indent):
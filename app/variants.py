@@ -0,0 +1,66 @@
+import os
+
+from code_obfuscator import CppCodeObfuscator, grammar_version, write_fragments
+from tree_cache import decode_tree, encode_tree
+
+
+def variant_seed(seed, index):
+    # Seed of one variant, main.py with --seed variant_seed(seed, index) writes the same file
+    return f'{seed}:{index}'
+
+
+def variant_filename(filename, index):
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}.{index}{ext or ".cpp"}'
+
+
+_worker_source = None
+_worker_spans = None
+_worker_settings = None
+
+
+def _init_worker(source, tree, version, settings):
+    # Every worker rebuilds the tree once from its binary form, instead of parsing the source again
+    global _worker_source, _worker_spans, _worker_settings
+    _worker_source = source
+    _worker_spans = decode_tree(source, tree, version)
+    _worker_settings = settings
+
+
+def _write_variant(seed, filename, source=None, spans=None, settings=None):
+    # Workers take the source, the tree and the settings set up by _init_worker
+    obfuscator = CppCodeObfuscator(_worker_source if source is None else source, seed=seed,
+                                   settings=_worker_settings if settings is None else settings)
+    obfuscator.use_spans(_worker_spans if spans is None else spans)
+    with open(filename, 'w') as f:
+        write_fragments(f, obfuscator.emit())
+    return filename
+
+
+def write_variants(obfuscator, filename, seed, count, jobs=None):
+    # Parses once and writes count variants of the source as filename.<index>.cpp, emission is spread over jobs worker
+    # processes. Returns (seed, filename) pairs
+    if not obfuscator.spans and not obfuscator.load_tree():
+        obfuscator.parse()
+    seeds = [variant_seed(seed, i) for i in range(count)]
+    filenames = [variant_filename(filename, i) for i in range(count)]
+    version = grammar_version()
+    tree = None
+    if count > 1 and jobs != 1:
+        try:
+            tree = encode_tree(obfuscator.source_code, obfuscator.spans, version)
+        except (TypeError, RecursionError):
+            # The binary format has no record for a value of a node or the tree is too deep for it,
+            # the variants are emitted in this process
+            tree = None
+
+    if tree is None:
+        for variant in zip(seeds, filenames):
+            _write_variant(*variant, obfuscator.source_code, obfuscator.spans, obfuscator.settings)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count() or 1, count), initializer=_init_worker,
+                                 initargs=(obfuscator.source_code, tree, version, obfuscator.settings)) as executor:
+            list(executor.map(_write_variant, seeds, filenames))
+    return list(zip(seeds, filenames))
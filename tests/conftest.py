@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+EXAMPLES = os.path.join(os.path.dirname(APP), 'examples')
+# The app modules import each other by their plain names
+sys.path.insert(0, APP)
+
+
+def example_sources():
+    sources = []
+    for filename in sorted(os.listdir(EXAMPLES)):
+        with open(os.path.join(EXAMPLES, filename)) as f:
+            sources.append(pytest.param(f.read(), id=filename))
+    return sources
+
+
+def corpus_sources(size=8 * 1024):
+    from corpus_generator import SHAPES, generate_source
+    return [pytest.param(generate_source(size, shape), id=shape) for shape in SHAPES]
+
+
+def obfuscate(source, **kwargs):
+    from code_obfuscator import CppCodeObfuscator
+    obfuscator = CppCodeObfuscator(source, seed=1, **kwargs)
+    obfuscator.obfuscate()
+    return obfuscator.processed_code
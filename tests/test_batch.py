@@ -0,0 +1,17 @@
+import pytest
+
+from batch import collect_sources
+
+
+def test_same_name_in_two_directories(tmp_path):
+    for directory in ('a', 'b'):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / 'x.cpp').write_text('int main() {}\n')
+    with pytest.raises(ValueError):
+        collect_sources([str(tmp_path / 'a' / 'x.cpp'), str(tmp_path / 'b' / 'x.cpp')])
+
+
+def test_file_named_twice(tmp_path):
+    (tmp_path / 'x.cpp').write_text('int main() {}\n')
+    assert collect_sources([str(tmp_path / 'x.cpp'), str(tmp_path), str(tmp_path / '*.cpp')]) == [
+        (str(tmp_path / 'x.cpp'), 'x.cpp')]
@@ -0,0 +1,27 @@
+import pytest
+
+from code_obfuscator import CppCodeObfuscator
+
+# Unbalanced < of template arguments between two functions, CType recurses on every one of them
+UNBALANCED = 'int f() {\n    return 1;\n}\n' + 'map<' * 100 + 'int x;\n' + 'int g() {\n    return 2;\n}\n'
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'max_steps': 100}, {'max_seconds': 0.5}], ids=['none', 'steps', 'seconds'])
+def test_nested_too_deep(kwargs):
+    obfuscator = CppCodeObfuscator(UNBALANCED, seed=1, **kwargs)
+    obfuscator.obfuscate()
+    start = UNBALANCED.index('map<')
+    end = UNBALANCED.index(';', start) + 1
+    assert obfuscator.degraded == [(start, end, None)]
+    assert UNBALANCED[start:end] in obfuscator.processed_code
+    assert 'int g () {' in obfuscator.processed_code
+    assert 'nested too deep' in obfuscator.degraded_report()[0]
+
+
+def test_over_the_budget():
+    source = 'int f() {\n' + '    x = a + b * c - d;\n' * 50 + '}\nint g() {\n    return 2;\n}\n'
+    obfuscator = CppCodeObfuscator(source, seed=1, max_steps=40)
+    obfuscator.obfuscate()
+    assert [item[:2] for item in obfuscator.degraded] == [(0, source.index('}') + 1)]
+    assert obfuscator.degraded[0][2] > 40
+    assert source[:source.index('}') + 1] in obfuscator.processed_code
@@ -0,0 +1,57 @@
+import pytest
+
+from conftest import corpus_sources, example_sources, obfuscate
+
+SOURCES = example_sources() + corpus_sources()
+
+# Edits in the middle of the source that change how the text after them is lexed or parsed
+EDITS = [
+    pytest.param('/* unterminated\n', id='comment'),
+    pytest.param('#define MACRO \\\n', id='preprocessor'),
+    pytest.param('const char *text = "unterminated\\\n', id='string'),
+    pytest.param('int added = 1;\n', id='declaration'),
+]
+
+
+def cached(tmp_path, source, name='source.cpp'):
+    from refactor_cache import RefactorCache
+    cache = RefactorCache(str(tmp_path / 'cache'))
+    try:
+        return obfuscate(source, cache=cache, name=name)
+    finally:
+        cache.close()
+
+
+@pytest.mark.parametrize('source', SOURCES)
+def test_cached_run_is_uncached_run(tmp_path, source):
+    assert cached(tmp_path, source) == obfuscate(source)
+    assert cached(tmp_path, source) == obfuscate(source)
+
+
+@pytest.mark.parametrize('edit', EDITS)
+@pytest.mark.parametrize('source', SOURCES)
+def test_edit_in_the_middle(tmp_path, source, edit):
+    middle = source.index('\n', len(source) // 2) + 1
+    edited = source[:middle] + edit + source[middle:]
+    cached(tmp_path, source)
+    assert cached(tmp_path, edited) == obfuscate(edited)
+
+
+def test_no_transaction_between_commits(tmp_path):
+    from refactor_cache import RefactorCache
+    first = RefactorCache(str(tmp_path / 'cache'))
+    second = RefactorCache(str(tmp_path / 'cache'))
+    second.db.execute('PRAGMA busy_timeout = 0')
+    try:
+        first.put('a', 'output of a')
+        assert first.get('a') == 'output of a'
+        assert not first.db.in_transaction
+        # The other process writes while the first one is still refactoring
+        second.put('b', 'output of b')
+        second.commit()
+        assert first.get('b') == 'output of b'
+        first.commit()
+        assert second.get('a') == 'output of a'
+    finally:
+        first.close()
+        second.close()
@@ -0,0 +1,44 @@
+import io
+
+import pytest
+
+from code_obfuscator import CppCodeObfuscator
+from conftest import corpus_sources, example_sources, obfuscate
+
+SOURCES = example_sources() + corpus_sources()
+
+
+def split(source, chunk_size, jobs=1, **kwargs):
+    from chunks import obfuscate_chunks
+    stream = io.StringIO()
+    obfuscate_chunks(CppCodeObfuscator(source, seed=1, **kwargs), stream, chunk_size, jobs=jobs)
+    return stream.getvalue()
+
+
+@pytest.mark.parametrize('chunk_size', [97, 1024])
+@pytest.mark.parametrize('source', SOURCES)
+def test_split_is_serial(source, chunk_size):
+    assert split(source, chunk_size) == obfuscate(source)
+
+
+@pytest.mark.parametrize('source', corpus_sources())
+def test_split_in_processes(source):
+    assert split(source, 1024, jobs=2) == obfuscate(source)
+
+
+@pytest.mark.parametrize('source', corpus_sources())
+def test_split_over_the_budget(source):
+    # Elements given up over the budget are given up in the chunks too
+    serial = CppCodeObfuscator(source, seed=1, max_steps=40)
+    serial.obfuscate()
+    assert serial.degraded
+    assert split(source, 1024, max_steps=40) == serial.processed_code
+
+
+def test_parse_range():
+    source = 'int a;\nint f() {\n    return 1;\n}\nint b;\n'
+    obfuscator = CppCodeObfuscator(source, seed=1)
+    spans, degraded = obfuscator.parse_range(source.index('int f'), source.index('int b'))
+    assert [source[start:end] for start, end, part in spans if not isinstance(part, str)] == [
+        'int f() {\n    return 1;\n}']
+    assert degraded == []
@@ -0,0 +1,40 @@
+import re
+
+import pytest
+
+from conftest import obfuscate
+from lexer import TokenStream
+
+SOURCE = '''// top comment
+int main() {
+    int n = 3; // count
+    for (int i = 0; i < n; i++) /* c */ {
+        n = n /* inner */ + 1; // trailing
+    }
+    if (n > 2) /* cond */ {
+        return /* r */ 1;
+    } /* between */ else {
+        return 0;
+    }
+}
+'''
+
+
+@pytest.mark.parametrize('comment', re.findall(r'//[^\n]*|/\*.*?\*/', SOURCE))
+def test_comment_kept(comment):
+    assert comment in obfuscate(SOURCE)
+
+
+def test_comment_before_brace():
+    assert 'i++) /* c */ {' in obfuscate(SOURCE)
+
+
+def test_line_comment_ends_line():
+    output = obfuscate('int f() {\n    if (x) // why\n    {\n        return 1;\n    }\n}\n')
+    assert re.search(r'// why\n\s*\{', output)
+
+
+def test_trivia_reconstructs_source():
+    tokens = TokenStream(SOURCE)
+    text = ''.join(tokens.trivia(i) + tokens.token_text(i) for i in range(len(tokens.starts)))
+    assert text == SOURCE
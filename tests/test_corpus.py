@@ -0,0 +1,15 @@
+import pytest
+
+from corpus_generator import SHAPES, generate_source
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_size_follows_the_request(shape):
+    for size in (1024, 8 * 1024, 16 * 1024, 64 * 1024):
+        assert size <= len(generate_source(size, shape)) <= 1.25 * size
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_same_seed_same_source(shape):
+    assert generate_source(4096, shape, seed=3) == generate_source(4096, shape, seed=3)
+    assert generate_source(4096, shape, seed=3) != generate_source(4096, shape, seed=4)
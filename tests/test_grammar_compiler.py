@@ -0,0 +1,41 @@
+import pytest
+
+from conftest import corpus_sources, example_sources, obfuscate
+
+SOURCES = example_sources() + corpus_sources()
+
+
+@pytest.fixture(scope='module')
+def compiled():
+    import grammar_compiler
+    return grammar_compiler.load()
+
+
+@pytest.mark.parametrize('source', SOURCES)
+def test_compiled_is_interpreted(compiled, source):
+    import grammar_compiler
+    interpreted = obfuscate(source)
+    grammar_compiler.install(compiled)
+    try:
+        assert obfuscate(source) == interpreted
+    finally:
+        grammar_compiler.uninstall()
+
+
+def test_uninstall(compiled):
+    import grammar_compiler
+    from lang_objects import CType
+    match = CType.__dict__.get('match')
+    grammar_compiler.install(compiled)
+    grammar_compiler.uninstall()
+    assert CType.__dict__.get('match') is match
+
+
+def test_old_modules_removed(tmp_path):
+    import grammar_compiler
+    (tmp_path / 'grammar_0000000000000000.py').write_text('RULES = {}\n')
+    (tmp_path / 'other.py').write_text('')
+    module = grammar_compiler.load(str(tmp_path))
+    assert module.RULES
+    assert sorted(path.name for path in tmp_path.glob('*.py')) == sorted(
+        [f'grammar_{grammar_compiler.compiled_version()[:16]}.py', 'other.py'])
@@ -0,0 +1,23 @@
+import pytest
+
+from conftest import corpus_sources, example_sources, obfuscate
+from parser_utils import PackratCache
+
+
+@pytest.mark.parametrize('memo_size', [0, 16])
+@pytest.mark.parametrize('source', example_sources() + corpus_sources())
+def test_memo_does_not_change_output(source, memo_size):
+    assert obfuscate(source, memo_size=memo_size) == obfuscate(source)
+
+
+def test_bounded():
+    memo = PackratCache(2)
+    for index in range(3):
+        memo.put(PackratCache, index, None, index)
+    assert len(memo) == 2
+    assert memo.get(PackratCache, 0) is None
+    assert memo.get(PackratCache, 2) == (None, 2)
+    # A hit is the most recently used entry, the other one goes first
+    memo.put(PackratCache, 3, None, 3)
+    assert memo.get(PackratCache, 2) == (None, 2)
+    assert memo.get(PackratCache, 1) is None
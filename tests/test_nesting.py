@@ -0,0 +1,37 @@
+import pytest
+
+from code_obfuscator import CppCodeObfuscator
+from conftest import corpus_sources, example_sources, obfuscate
+from profiler import RuleProfiler
+
+# Deeper than the python stack goes with a call per rule
+DEPTH = 2000
+
+
+def nested(opening):
+    return 'int main() {\nint x = 1;\n' + opening * DEPTH + 'x = 2;\n' + '}\n' * DEPTH + 'return 0;\n}\n'
+
+
+@pytest.mark.parametrize('opening', ['if (x) {\n', 'for (int i = 0; i < x; ++i) {\n', 'if (x) x = 1; else {\n'],
+                         ids=['if', 'for', 'else'])
+def test_deep_nesting(opening):
+    obfuscator = CppCodeObfuscator(nested(opening), seed=1)
+    obfuscator.obfuscate()
+    assert not obfuscator.degraded
+    assert obfuscator.processed_code.count('{') == DEPTH + 1
+
+
+@pytest.mark.parametrize('source', example_sources() + corpus_sources())
+def test_explicit_stack_is_recursion(source):
+    recursive = CppCodeObfuscator(source, seed=1)
+    recursive.context.explicit_stack = False
+    recursive.obfuscate()
+    assert recursive.processed_code == obfuscate(source)
+
+
+def test_profiled_deep_nesting():
+    source = nested('if (x) {\n')
+    profiler = RuleProfiler()
+    assert obfuscate(source, profiler=profiler) == obfuscate(source)
+    assert profiler.stats['CConstructionIfElse'].successes == DEPTH
+    assert not profiler._frames
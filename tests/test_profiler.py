@@ -0,0 +1,21 @@
+from conftest import obfuscate
+from profiler import RuleProfiler
+
+SOURCE = 'int main() {\n    return    0;\n}\n'
+
+
+def test_consumed_characters():
+    profiler = RuleProfiler()
+    obfuscate(SOURCE, profiler=profiler)
+    function = profiler.stats['CFunction']
+    assert function.successes == 1
+    assert function.consumed == len(SOURCE.strip())
+
+
+def test_stacks():
+    profiler = RuleProfiler()
+    obfuscate(SOURCE, profiler=profiler)
+    stacks = profiler.stacks
+    assert 'CFunction' in stacks
+    assert all(path.split(';')[-1] in {x.frame_name for x in profiler.stats.values()} for path in stacks)
+    assert abs(sum(stacks.values()) - sum(x.self_time for x in profiler.stats.values())) < 1e-6
@@ -0,0 +1,59 @@
+import pytest
+
+from code_obfuscator import CppCodeObfuscator
+from symbols import SymbolIndex, build_index, collect
+
+SOURCE = '''#include <vector>
+
+int size = 3;
+
+class Counter {
+public:
+    int count;
+    int next() {
+        count = count + 1;
+        return count;
+    }
+};
+
+int main() {
+    std::vector<int> v;
+    Counter c;
+    c.count = v.size() + std::size(v) + size;
+    return c.next();
+}
+'''
+
+
+def renamed(tmp_path, source):
+    filename = str(tmp_path / 'source.cpp')
+    obfuscator = CppCodeObfuscator(source, seed=1)
+    obfuscator.parse()
+    build_index(str(tmp_path / 'symbols'), [filename], [collect(obfuscator, filename)], seed=1)
+    index = SymbolIndex(str(tmp_path / 'symbols'))
+    try:
+        return index, index.rename(source)
+    finally:
+        index.close()
+
+
+def test_member_access(tmp_path):
+    with pytest.warns(UserWarning, match='<vector>'):
+        index, output = renamed(tmp_path, SOURCE)
+    assert 'v.size()' in output
+    assert 'std::size(v)' in output
+    size = index.get('size')
+    count = index.get('count')
+    assert size is not None and f'+ {size};' in output
+    assert count is not None and f'c.{count} = ' in output
+    assert f'c.{index.get("next")}()' in output
+
+
+def test_project_scope(tmp_path):
+    source = 'class Shape {\npublic:\n    int area();\n};\n\nint Shape::area() {\n    return std::area();\n}\n'
+    index, output = renamed(tmp_path, source)
+    shape = index.get('Shape')
+    area = index.get('area')
+    assert shape is not None and area is not None
+    assert f'int {shape}::{area}() {{' in output
+    assert 'std::area()' in output
@@ -0,0 +1,36 @@
+from random import Random
+
+import pytest
+
+from code_obfuscator import CppCodeObfuscator, obfuscate_many
+from conftest import example_sources
+
+# Members of a class are shuffled by the rng of the obfuscation
+CLASS = 'class A {\npublic:\n' + ''.join(f'    int m{i};\n' for i in range(20)) + '};\n'
+
+
+def parsed_class():
+    obfuscator = CppCodeObfuscator(CLASS, seed=1)
+    obfuscator.parse()
+    return next(part for _, _, part in obfuscator.spans if not isinstance(part, str))
+
+
+def test_seeded_threads():
+    sources = [param.values[0] for param in example_sources()] + [CLASS]
+    expected = []
+    for source in sources:
+        obfuscator = CppCodeObfuscator(source, seed=1)
+        obfuscator.obfuscate()
+        expected.append(obfuscator.processed_code)
+    assert obfuscate_many(CppCodeObfuscator(source, seed=1) for source in sources * 4) == expected * 4
+
+
+def test_class_needs_rng():
+    node = parsed_class()
+    with pytest.raises(TypeError):
+        node.refactor()
+    assert node.refactor(rng=Random(1)) == node.refactor(rng=Random(1))
+
+
+def test_repr_is_deterministic():
+    assert repr(parsed_class()) == repr(parsed_class())
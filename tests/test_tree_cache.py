@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+from code_obfuscator import CppCodeObfuscator
+from conftest import corpus_sources, example_sources
+from tree_cache import TreeCache
+
+
+@pytest.mark.parametrize('source', example_sources() + corpus_sources())
+def test_loaded_tree(tmp_path, source):
+    cache = TreeCache(str(tmp_path))
+    outputs = []
+    for _ in range(2):
+        obfuscator = CppCodeObfuscator(source, seed=1, tree_cache=cache)
+        obfuscator.obfuscate()
+        outputs.append(obfuscator.processed_code)
+    assert cache.hits == 1
+    assert outputs[0] == outputs[1]
+
+
+def test_eviction_scans(tmp_path, monkeypatch):
+    cache = TreeCache(str(tmp_path), max_bytes=64 * 1024)
+    scans = []
+    evict = cache._evict
+    monkeypatch.setattr(cache, '_evict', lambda: scans.append(evict()))
+    for number in range(200):
+        obfuscator = CppCodeObfuscator(f'int f{number}(int x) {{\n    return x + {number};\n}}\n', tree_cache=cache)
+        obfuscator.parse()
+    size = sum(entry.stat().st_size for entry in os.scandir(tmp_path) if entry.name.endswith('.tree'))
+    assert size <= cache.max_bytes
+    assert len(scans) < 40